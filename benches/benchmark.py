@@ -1,20 +1,154 @@
+"""Tracer overhead benchmarks.
+
+Run from the repository root with `python -m benches.benchmark`. Results are
+written as JSON, and `--compare previous.json` reports each case's change in
+overhead against an earlier run, exiting non-zero past `--threshold`.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
 import time
-from observe_dag.stack_trace import NodeStack
+import tracemalloc
+from typing import Callable, Optional
 
+from benches.cases import CASES, tree
+from sentiml.backends import TracingBackend, MonitoringBackend, SetTraceBackend, SamplingBackend, ImportHookBackend
+from sentiml.stack_trace import NodeStack
+from sentiml.tracking_type import TrackingType
 
-def f():
-    return True
+# Name => Factory of each backend this interpreter supports.
+BACKENDS: dict[str, Callable[[], TracingBackend]] = {
+    name: factory
+    for name, backend, factory in (
+        ("monitoring", MonitoringBackend, MonitoringBackend),
+        ("settrace", SetTraceBackend, SetTraceBackend),
+        ("sampling", SamplingBackend, SamplingBackend),
+        ("import_hook", ImportHookBackend, lambda: ImportHookBackend(["benches.cases"])),
+    )
+    if backend.supported()
+}
 
 
-if __name__ == "__main__":
-    now = time.time()
-    for _ in range(10_000):
-        _ = f()
-    diff = time.time() - now
+def _stack(aggregate: bool) -> NodeStack:
+    # The benchmark's own frames are on the stack too, and would use up the default depth before the workload.
+    return NodeStack(TrackingType.Processing, max_depth=sys.maxsize, aggregate=aggregate)
+
+
+def _timed(case: Callable[[int], None], calls: int) -> float:
+    started = time.perf_counter()
+    case(calls)
+    return time.perf_counter() - started
+
+
+def _traced(backend: TracingBackend, stack: NodeStack, case: Callable[[int], None], calls: int) -> float:
+    backend.start(stack)
+    try:
+        return _timed(case, calls)
+    finally:
+        backend.stop()
+
+
+def run_case(name: str, backend_name: str, calls: int, repeat: int, aggregate: bool) -> dict:
+    case = CASES[name]
+    baseline = min(_timed(case, calls) for _ in range(repeat))
+    traced = [
+        _traced(BACKENDS[backend_name](), _stack(aggregate), case, calls)
+        for _ in range(repeat)
+    ]
+    return {
+        "case": name,
+        "calls": calls,
+        "baseline_s": baseline,
+        "traced_s": min(traced),
+        "overhead_ns_per_call": (min(traced) - baseline) * 1e9 / calls,
+        "slowdown": min(traced) / baseline if baseline > 0 else None,
+    }
 
-    trace_now = time.time()
-    for _ in range(10_000):
-        _ = f()
-    trace_diff = time.time() - now
 
-    print(f"{now=}, {trace_now} ({trace_diff}=)")
+def run_dump(backend_name: str, fanout: int, depth: int, aggregate: bool) -> dict:
+    stack = _stack(aggregate)
+    backend = BACKENDS[backend_name]()
+    backend.start(stack)
+    tree(fanout, depth)
+    backend.stop()
+    tracemalloc.start()
+    started = time.perf_counter()
+    stack.dump()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "case": "dump",
+        "calls": sum(fanout ** level for level in range(depth + 1)),
+        "dump_s": elapsed,
+        "dump_peak_bytes": peak,
+    }
+
+
+def compare(results: dict, previous: dict, threshold: float) -> bool:
+    """Print each case's change against `previous`, returning whether any regressed past `threshold`."""
+    previous_cases = {case["case"]: case for case in previous["results"]}
+    regressed = False
+    for case in results["results"]:
+        if (before := previous_cases.get(case["case"])) is None:
+            continue
+        for metric in ("overhead_ns_per_call", "dump_s", "dump_peak_bytes"):
+            if case.get(metric) is None or not before.get(metric):
+                continue
+            ratio = case[metric] / before[metric]
+            flag = " REGRESSED" if ratio > threshold else ""
+            regressed = regressed or ratio > threshold
+            print(f"{case['case']:>16} {metric:<22} {before[metric]:>14.1f} -> {case[metric]:>14.1f} ({ratio:.2f}x){flag}",
+                  file=sys.stderr)
+    return regressed
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=(
+        "monitoring" if MonitoringBackend.supported() else "settrace"
+    ))
+    parser.add_argument("--cases", nargs="*", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--calls", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--aggregate", action="store_true")
+    parser.add_argument("--dump-fanout", type=int, default=4)
+    parser.add_argument("--dump-depth", type=int, default=7)
+    parser.add_argument("--output", help="File to write results to, rather than stdout.")
+    parser.add_argument("--compare", help="Results of an earlier run to compare against.")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    # Keep the dumped traces out of the user's own.
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="sentiml-bench-")
+    results = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "backend": args.backend,
+        "aggregate": args.aggregate,
+        "results": [
+            run_case(name, args.backend, args.calls, args.repeat, args.aggregate)
+            for name in args.cases
+        ],
+    }
+    results["results"].append(run_dump(args.backend, args.dump_fanout, args.dump_depth, args.aggregate))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare is not None:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""Workloads traced by the benchmark, kept out of __main__ so their module is included."""
+from __future__ import annotations
+
+from typing import Any
+
+
+def tiny() -> bool:
+    return True
+
+
+def tiny_calls(n: int) -> None:
+    for _ in range(n):
+        tiny()
+
+
+def recurse(depth: int) -> int:
+    if depth == 0:
+        return 0
+    return recurse(depth - 1) + 1
+
+
+def deep_recursion(n: int, depth: int = 200) -> None:
+    for _ in range(n // depth):
+        recurse(depth)
+
+
+def leaf(i: int) -> int:
+    return i
+
+
+def branch(width: int) -> int:
+    return sum(leaf(i) for i in range(width))
+
+
+def wide_fanout(n: int, width: int = 100) -> None:
+    for _ in range(n // width):
+        branch(width)
+
+
+class Layer:
+    def __init__(self, scale: float = 1.0):
+        self.scale = scale
+
+    def forward(self, x: float) -> float:
+        return self.activate(x * self.scale)
+
+    def activate(self, x: float) -> float:
+        return max(x, 0.0)
+
+    @classmethod
+    def build(cls) -> Layer:
+        return cls()
+
+
+def method_calls(n: int) -> None:
+    layer = Layer.build()
+    for i in range(n // 2):
+        layer.forward(float(i))
+
+
+def consume(values: Any, weights: Any) -> int:
+    return len(values)
+
+
+def large_arguments(n: int) -> None:
+    values = list(range(1_000_000))
+    try:
+        import numpy
+        weights = numpy.zeros((1024, 1024))
+    except ImportError:
+        weights = bytes(8 * 1024 * 1024)
+    for _ in range(n):
+        consume(values, weights)
+
+
+def tree(fanout: int, depth: int) -> None:
+    if depth == 0:
+        return None
+    for _ in range(fanout):
+        tree(fanout, depth - 1)
+
+
+CASES = {
+    "tiny_calls": tiny_calls,
+    "deep_recursion": deep_recursion,
+    "wide_fanout": wide_fanout,
+    "method_calls": method_calls,
+    "large_arguments": large_arguments,
+}
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import json
+import pathlib
+import sqlite3
+import sys
+import uuid
+import zlib
+from typing import Optional, Iterator, Iterable
+
+from sentiml.sources import source_location, file_for
+from sentiml.stack_element import StackElement
+from sentiml.trace_id import TraceID
+from sentiml.tracking_type import TrackingType
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    tracking_type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    module TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    first_line INTEGER NOT NULL,
+    payload BLOB NOT NULL,
+    PRIMARY KEY (tracking_type, name, filename, first_line)
+);
+CREATE INDEX IF NOT EXISTS nodes_by_name ON nodes (name);
+CREATE INDEX IF NOT EXISTS nodes_by_module ON nodes (module, tracking_type);
+CREATE TABLE IF NOT EXISTS sources (
+    file_hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    text BLOB NOT NULL
+);
+"""
+
+
+class TraceArchive:
+    """Single SQLite file holding every node dumped during a run.
+
+    Nodes are indexed by tracking type, name and module, and each node's JSON is
+    stored zlib-compressed. Names are slugified and can collide, so a node is
+    keyed by the location of its code as well as its name.
+
+    Source files are stored once, keyed by the hash of their contents, and each
+    node's "source" points at its lines within one of them.
+    """
+    FILENAME = "trace.sqlite"
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(_SCHEMA)
+
+    @classmethod
+    def for_run(cls) -> TraceArchive:
+        return TraceArchive(TraceID.root_dir() / cls.FILENAME)
+
+    def __enter__(self) -> TraceArchive:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @staticmethod
+    def _row(stack_type: TrackingType, node: StackElement) -> tuple:
+        return (
+            str(stack_type),
+            node.name(),
+            node.module,
+            node.description.co_filename,
+            node.description.co_firstlineno,
+            zlib.compress(json.dumps(node._json_repr(), default=str).encode()),
+        )
+
+    def add_nodes(self, stack_type: TrackingType, nodes: Iterable[StackElement]) -> None:
+        """Store `nodes` & their source files, keeping the existing entry wherever one was already stored."""
+        file_hashes = set()
+
+        def rows() -> Iterator[tuple]:
+            for node in nodes:
+                if (location := source_location(node.description)) is not None:
+                    file_hashes.add(location.file_hash)
+                yield self._row(stack_type, node)
+
+        with self._connection:
+            self._connection.executemany("INSERT OR IGNORE INTO nodes VALUES (?, ?, ?, ?, ?, ?)", rows())
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO sources VALUES (?, ?, ?)",
+                (
+                    (file.file_hash, file.filename, zlib.compress(file.text().encode("utf-8", "surrogateescape")))
+                    for file in map(file_for, file_hashes)
+                ),
+            )
+
+    def merge(self, path: pathlib.Path) -> None:
+        """Copy in every node of the archive at `path`, keeping existing entries on conflict."""
+        self._connection.execute("ATTACH DATABASE ? AS other", (str(path),))
+        try:
+            with self._connection:
+                self._connection.execute("INSERT OR IGNORE INTO nodes SELECT * FROM other.nodes")
+                self._connection.execute("INSERT OR IGNORE INTO sources SELECT * FROM other.sources")
+        finally:
+            self._connection.execute("DETACH DATABASE other")
+
+    def _query(self, clauses: dict[str, Optional[str]]) -> Iterator[dict]:
+        clauses = {column: value for column, value in clauses.items() if value is not None}
+        where = " AND ".join(f"{column} = ?" for column in clauses) or "1"
+        for (payload,) in self._connection.execute(
+                f"SELECT payload FROM nodes WHERE {where}", tuple(clauses.values())
+        ):
+            yield json.loads(zlib.decompress(payload))
+
+    def node(self, stack_type: TrackingType, name: str) -> Optional[dict]:
+        return next(self._query({"tracking_type": str(stack_type), "name": name}), None)
+
+    def source(self, node: dict) -> Optional[str]:
+        """Source of a node returned by `node` or `nodes`."""
+        if (location := node.get("source")) is None:
+            return None
+        row = self._connection.execute(
+            "SELECT text FROM sources WHERE file_hash = ?", (location["file_hash"],)
+        ).fetchone()
+        if row is None:
+            return None
+        lines = zlib.decompress(row[0]).decode("utf-8", "surrogateescape").splitlines(keepends=True)
+        return "".join(lines[location["first_line"] - 1:location["last_line"]])
+
+    def nodes(
+            self,
+            stack_type: Optional[TrackingType] = None,
+            name: Optional[str] = None,
+            module: Optional[str] = None,
+    ) -> Iterator[dict]:
+        return self._query({
+            "tracking_type": str(stack_type) if stack_type is not None else None,
+            "name": name,
+            "module": module,
+        })
+
+
+if __name__ == "__main__":
+    TraceID.use(uuid.UUID(sys.argv[1]))
+    with TraceArchive.for_run() as archive:
+        node = archive.node(TrackingType[sys.argv[2]], sys.argv[3])
+        print(json.dumps(node, indent=2))
+        if node is not None and (source := archive.source(node)) is not None:
+            print(source)
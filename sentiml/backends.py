@@ -0,0 +1,501 @@
+from __future__ import annotations
+
+import abc
+import dis
+import sys
+import threading
+from typing import Optional, Any, Callable, Sequence
+
+from sentiml.import_hook import WrappingHook
+from sentiml.inclusion import module_verdict
+from sentiml.protocols import FrameProtocol, CodeProtocol
+from sentiml.call_stack import CallStack
+from sentiml.stack_element import StackElement
+from sentiml.stack_trace import NodeStack
+
+
+class TracingBackend(abc.ABC):
+    """Mechanism by which the interpreter reports calls to a NodeStack."""
+
+    @staticmethod
+    def supported() -> bool:
+        return True
+
+    @abc.abstractmethod
+    def start(self, tracker: NodeStack) -> None:
+        ...
+
+    @abc.abstractmethod
+    def stop(self) -> None:
+        ...
+
+    def pause(self) -> None:
+        """Stop reporting calls until `resume`, e.g. outside of a traced region."""
+        self.stop()
+
+    def resume(self, tracker: NodeStack) -> None:
+        self.start(tracker)
+
+    def start_regions(self, tracker: NodeStack) -> None:
+        """Start reporting calls only within traced regions, which each thread opens with `enter_region`.
+
+        Backends which hook every thread at once report calls from all threads.
+        """
+        self.start(tracker)
+
+    def enter_region(self) -> None:
+        """The running thread opened its first traced region."""
+
+    def exit_region(self) -> None:
+        """The running thread closed its last traced region."""
+
+
+class SetTraceBackend(TracingBackend):
+    """sys.settrace backend.
+
+    Threads started while tracking are traced too. Threads which were already
+    running are only traced on interpreters with `threading.settrace_all_threads`.
+    Started for traced regions, only the threads within a region are traced, from
+    the calls made inside it.
+
+    `call_stack_options` are passed on to the CallStack, e.g. to track asyncio Tasks.
+    """
+    _YIELD_OPCODES = frozenset(dis.opmap[name] for name in ("YIELD_VALUE", "YIELD_FROM") if name in dis.opmap)
+    _RESUME_OPCODE = dis.opmap.get("RESUME")
+
+    def __init__(self, **call_stack_options):
+        self._previous_tracking_fn: Optional[Callable] = None
+        self._previous_thread_tracking_fn: Optional[Callable] = None
+        self._call_stack: Optional[CallStack] = None
+        self._call_stack_options = call_stack_options
+        # Hook which reports calls to the CallStack, given the hook it replaces.
+        self._hook: Optional[Callable[[Optional[Callable]], Callable]] = None
+        # Whether started for traced regions, where each thread within a region is hooked separately.
+        self._regions = False
+        self._region_threads = threading.local()
+
+    @staticmethod
+    def _is_suspending(frame: FrameProtocol, raised_at: Optional[int]) -> bool:
+        """Whether a return from `frame` is a yield or await, given where it last raised an exception.
+
+        settrace reports a yield or await as a return, only the instruction tells them
+        apart: the yield itself, or from 3.12, the RESUME which follows it.
+        """
+        lasti = frame.f_lasti
+        code = frame.f_code.co_code
+        if raised_at == lasti:
+            # An exception thrown in at the yield, e.g. GeneratorExit from close(), which is propagating out.
+            return False
+        opcode = code[lasti]
+        return opcode in SetTraceBackend._YIELD_OPCODES or (
+                opcode == SetTraceBackend._RESUME_OPCODE and lasti >= 2
+                and code[lasti - 2] in SetTraceBackend._YIELD_OPCODES
+        )
+
+    def _hooks(self, tracker: NodeStack, seed_running: bool) -> Callable[[Optional[Callable]], Callable]:
+        """Factory of the hook which reports calls to a new CallStack, given the hook it replaces.
+
+        With `seed_running`, the frames already running when a thread is first seen are pushed too.
+        """
+        call_stack = self._call_stack = CallStack(tracker, **self._call_stack_options)
+        call_stack.seed_running = seed_running
+        is_suspending = self._is_suspending
+        # id(Frame) => Instruction at which it last raised, when tracking Tasks.
+        raised_at: dict[int, int] = dict()
+
+        def frame_tracking_fn(
+                frame: FrameProtocol, event: str, arg_frame: Optional[Any]
+        ):
+            if event == "return":
+                if call_stack.tracks_tasks and is_suspending(frame, raised_at.pop(id(frame), None)):
+                    call_stack.exit(frame.f_code, suspended_frame=frame)
+                else:
+                    call_stack.exit(frame.f_code)
+            elif event == "exception" and call_stack.tracks_tasks:
+                raised_at[id(frame)] = frame.f_lasti
+            return frame_tracking_fn
+
+        def trace_frame(frame: FrameProtocol) -> None:
+            # Only returns are needed from included frames, so skip their line events.
+            frame.f_trace_lines = False
+            frame.f_trace = frame_tracking_fn
+
+        def hook(previous_tracking_fn: Optional[Callable]) -> Callable:
+            def tracking_fn(
+                    frame: Optional[FrameProtocol], event: str, arg_frame: Optional[Any]
+            ):
+                frame_fn = None
+                if event == "call" and frame is not None:
+                    if not call_stack.is_seeded():
+                        for running_frame in call_stack.seed(frame.f_back if call_stack.seed_running else None):
+                            trace_frame(running_frame)
+                    if not call_stack.is_disabled(frame.f_code) and call_stack.enter(frame):
+                        frame.f_trace_lines = False
+                        frame_fn = frame_tracking_fn
+                if previous_tracking_fn is not None:
+                    previous_tracking_fn(frame, event, arg_frame)
+                return frame_fn
+
+            return tracking_fn
+
+        return hook
+
+    def start(self, tracker: NodeStack) -> None:
+        self._hook = self._hooks(tracker, seed_running=True)
+        self._regions = False
+        self._attach()
+
+    def start_regions(self, tracker: NodeStack) -> None:
+        # Calls are only reported from the region down, rather than from the frames which opened it.
+        self._hook = self._hooks(tracker, seed_running=False)
+        self._regions = True
+
+    def _attach(self) -> None:
+        self._previous_tracking_fn = sys.gettrace()
+        self._previous_thread_tracking_fn = threading.gettrace()
+        tracking_fn = self._hook(self._previous_tracking_fn)
+        self._settrace(tracking_fn, tracking_fn)
+
+    def _detach(self) -> None:
+        if self._regions:
+            # Every other thread removed its own hook when it left its last region.
+            self.exit_region()
+        else:
+            self._settrace(self._previous_tracking_fn, self._previous_thread_tracking_fn)
+        self._previous_tracking_fn = None
+        self._previous_thread_tracking_fn = None
+
+    def enter_region(self) -> None:
+        if self._regions and self._hook is not None:
+            self._region_threads.previous_tracking_fn = previous_tracking_fn = sys.gettrace()
+            self._region_threads.hooked = True
+            sys.settrace(self._hook(previous_tracking_fn))
+
+    def exit_region(self) -> None:
+        if getattr(self._region_threads, 'hooked', False):
+            sys.settrace(self._region_threads.previous_tracking_fn)
+            self._region_threads.previous_tracking_fn = None
+            self._region_threads.hooked = False
+
+    def pause(self) -> None:
+        """Remove the hooks, but keep recording into the same CallStack on `resume`."""
+        if self._call_stack is None:
+            return None
+        self._detach()
+        self._call_stack.detach()
+
+    def resume(self, tracker: NodeStack) -> None:
+        if self._call_stack is None and self._regions:
+            self.start_regions(tracker)
+        elif self._call_stack is None:
+            self.start(tracker)
+        elif not self._regions:
+            self._attach()
+
+    @staticmethod
+    def _settrace(tracking_fn: Optional[Callable], thread_tracking_fn: Optional[Callable]) -> None:
+        if hasattr(threading, 'settrace_all_threads') and tracking_fn is thread_tracking_fn:
+            threading.settrace_all_threads(tracking_fn)
+        else:
+            threading.settrace(thread_tracking_fn)
+            sys.settrace(tracking_fn)
+
+    def stop(self) -> None:
+        if self._call_stack is None:
+            return None
+        self._detach()
+        self._call_stack.unwind()
+        self._call_stack = None
+        self._hook = None
+
+
+class MonitoringBackend(TracingBackend):
+    """PEP 669 backend.
+
+    Only function start, resume, throw, return, yield and unwind events are
+    listened for, and code objects from excluded modules are disabled after their
+    first call so that they run without any callback.
+
+    Disabled code only runs callbacks again after `sys.monitoring.restart_events`,
+    which re-enables the events every tool (e.g. coverage) has disabled, so it's
+    only called on start when a previous run under the same tool id disabled code.
+
+    `call_stack_options` are passed on to the CallStack, e.g. to track asyncio Tasks.
+    """
+    TOOL_NAME = "sentiml"
+    # Tool IDs under which code was disabled since events were last restarted.
+    _disabled_tool_ids: set[int] = set()
+
+    def __init__(self, **call_stack_options):
+        self._tool_id: Optional[int] = None
+        self._events: list[int] = []
+        self._event_set: int = 0
+        self._seed_running = True
+        self._call_stack: Optional[CallStack] = None
+        self._call_stack_options = call_stack_options
+
+    @staticmethod
+    def supported() -> bool:
+        return hasattr(sys, "monitoring")
+
+    @staticmethod
+    def _acquire_tool_id() -> int:
+        monitoring = sys.monitoring
+        for tool_id in (monitoring.PROFILER_ID, 3, 4):
+            if monitoring.get_tool(tool_id) is None:
+                monitoring.use_tool_id(tool_id, MonitoringBackend.TOOL_NAME)
+                return tool_id
+        raise RuntimeError("No free sys.monitoring tool id available")
+
+    @staticmethod
+    def _callbacks(call_stack: CallStack, tool_id: int) -> dict[int, Callable]:
+        monitoring = sys.monitoring
+        disabled_tool_ids = MonitoringBackend._disabled_tool_ids
+
+        def disable():
+            disabled_tool_ids.add(tool_id)
+            return monitoring.DISABLE
+
+        def on_enter(code: CodeProtocol, instruction_offset: int):
+            # Only excluded code is disabled, calls skipped for other reasons (e.g. an unsampled Task) may
+            # be recorded elsewhere.
+            if not module_verdict(code)[1] or call_stack.is_disabled(code):
+                return disable()
+            call_stack.enter(sys._getframe(1))
+
+        def on_throw(code: CodeProtocol, instruction_offset: int, exception: BaseException):
+            # PY_THROW can't be disabled either.
+            if module_verdict(code)[1]:
+                call_stack.enter(sys._getframe(1))
+
+        def on_exit(code: CodeProtocol, instruction_offset: int, value: Any):
+            if not module_verdict(code)[1]:
+                return disable()
+            call_stack.exit(code)
+            if call_stack.is_disabled(code):
+                return disable()
+
+        def on_yield(code: CodeProtocol, instruction_offset: int, value: Any):
+            if not module_verdict(code)[1]:
+                return disable()
+            call_stack.exit(code, suspended_frame=sys._getframe(1))
+            if call_stack.is_disabled(code):
+                return disable()
+
+        def on_unwind(code: CodeProtocol, instruction_offset: int, exception: BaseException):
+            # PY_UNWIND can't be disabled, so excluded code has to be filtered here.
+            if module_verdict(code)[1]:
+                call_stack.exit(code)
+
+        return {
+            monitoring.events.PY_START: on_enter,
+            monitoring.events.PY_RESUME: on_enter,
+            monitoring.events.PY_THROW: on_throw,
+            monitoring.events.PY_RETURN: on_exit,
+            monitoring.events.PY_YIELD: on_yield,
+            monitoring.events.PY_UNWIND: on_unwind,
+        }
+
+    def _listen(self, tracker: NodeStack, seed_running: bool) -> None:
+        monitoring = sys.monitoring
+        events = monitoring.events.NO_EVENTS
+        self._call_stack = CallStack(tracker, **self._call_stack_options)
+        self._call_stack.seed_running = seed_running
+        self._events = []
+        for event, callback in self._callbacks(self._call_stack, self._tool_id).items():
+            monitoring.register_callback(self._tool_id, event, callback)
+            self._events.append(event)
+            events |= event
+        self._event_set = events
+        monitoring.set_events(self._tool_id, events)
+
+    def _start(self, tracker: NodeStack, seed_running: bool) -> None:
+        self._seed_running = seed_running
+        self._tool_id = self._acquire_tool_id()
+        if self._tool_id in MonitoringBackend._disabled_tool_ids:
+            # Code objects disabled by a previous run may now be relevant again.
+            sys.monitoring.restart_events()
+            MonitoringBackend._disabled_tool_ids.clear()
+        self._listen(tracker, seed_running)
+
+    def start(self, tracker: NodeStack) -> None:
+        self._start(tracker, seed_running=True)
+
+    def start_regions(self, tracker: NodeStack) -> None:
+        """Report calls from every thread, each from its first call rather than beneath the frames already running."""
+        self._start(tracker, seed_running=False)
+
+    def pause(self) -> None:
+        """Turn every event off while keeping the tool, so code disabled so far stays disabled on `resume`."""
+        if self._tool_id is None or self._call_stack is None:
+            return None
+        sys.monitoring.set_events(self._tool_id, sys.monitoring.events.NO_EVENTS)
+        self._call_stack.detach()
+
+    def resume(self, tracker: NodeStack) -> None:
+        if self._tool_id is None:
+            return self._start(tracker, self._seed_running)
+        # The callbacks are still registered, and still record into the same CallStack.
+        sys.monitoring.set_events(self._tool_id, self._event_set)
+
+    def stop(self) -> None:
+        if self._tool_id is None:
+            return None
+        monitoring = sys.monitoring
+        monitoring.set_events(self._tool_id, monitoring.events.NO_EVENTS)
+        for event in self._events:
+            monitoring.register_callback(self._tool_id, event, None)
+        self._events = []
+        monitoring.free_tool_id(self._tool_id)
+        self._tool_id = None
+        if self._call_stack is not None:
+            self._call_stack.unwind()
+            self._call_stack = None
+
+
+class SamplingBackend(TracingBackend):
+    """Statistical backend which never hooks into calls.
+
+    A background thread reads the stack of every other thread `rate` times a
+    second and merges each stack into the NodeStack by code object, counting how
+    many samples landed in each node. The resulting call graph is approximate,
+    but its overhead is independent of how many calls are made.
+    """
+
+    def __init__(self, rate: float = 100.0):
+        self._interval = 1.0 / rate
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._tracker: Optional[NodeStack] = None
+        # (Parent Element ID, Code) => Element, or None if the NodeStack excluded it.
+        self._sampled: dict[tuple[int, CodeProtocol], Optional[StackElement]] = dict()
+        self._thread_trackers: dict[int, NodeStack] = dict()  # Thread ID => NodeStack
+
+    def _thread_tracker(self, tracker: NodeStack, thread_id: int) -> NodeStack:
+        try:
+            return self._thread_trackers[thread_id]
+        except KeyError:
+            thread = {thread.ident: thread for thread in threading.enumerate()}.get(thread_id)
+            thread_name = thread.name if thread is not None else str(thread_id)
+            thread_tracker = self._thread_trackers[thread_id] = tracker.for_thread(thread_name, thread)
+            return thread_tracker
+
+    def _sample_stack(self, tracker: NodeStack, frame: Optional[FrameProtocol]) -> None:
+        frames = []
+        while frame is not None:
+            if module_verdict(frame.f_code)[1]:
+                frames.append(frame)
+            frame = frame.f_back
+        parent = None
+        for depth, frame in enumerate(reversed(frames), start=1):
+            if depth > tracker.max_depth:
+                break
+            key = (id(parent) if parent is not None else id(tracker), frame.f_code)
+            try:
+                element = self._sampled[key]
+            except KeyError:
+                element = self._sampled[key] = tracker.add_node(
+                    StackElement.from_frame(frame, parent=parent, depth=depth)
+                )
+            if element is not None:
+                tracker.add_sample(element)
+                parent = element
+
+    def _sample(self, tracker: NodeStack) -> None:
+        sampler_id = threading.get_ident()
+        frames = sys._current_frames()
+        for thread_id in [thread_id for thread_id in self._thread_trackers if thread_id not in frames]:
+            # The thread exited, and its ID may be reused by a new thread, which gets a stack of its own.
+            self._forget(frozenset([id(self._thread_trackers.pop(thread_id))]))
+        for thread_id, frame in frames.items():
+            if thread_id != sampler_id:
+                thread_tracker = self._thread_tracker(tracker, thread_id)
+                self._sample_stack(thread_tracker, frame)
+                # No call is ever completed, so each tick is when the limits are checked.
+                thread_tracker.check_limits()
+
+    def _forget(self, dropped_ids: frozenset[int]) -> None:
+        """Drop the elements in `dropped_ids`, which were evicted or rotated out, and the paths beneath them."""
+        for key, element in list(self._sampled.items()):
+            if key[0] in dropped_ids or (element is not None and id(element) in dropped_ids):
+                del self._sampled[key]
+
+    def _run(self, tracker: NodeStack) -> None:
+        while not self._stopped.wait(self._interval):
+            self._sample(tracker)
+
+    def start(self, tracker: NodeStack) -> None:
+        self._tracker = tracker
+        tracker.add_drop_listener(self._forget)
+        self.resume(tracker)
+
+    def pause(self) -> None:
+        """Stop sampling, but keep sampling into the same stacks on `resume`."""
+        if self._thread is None:
+            return None
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def resume(self, tracker: NodeStack) -> None:
+        if self._tracker is None:
+            return self.start(tracker)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(tracker,), name="sentiml-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._tracker is None:
+            return None
+        self.pause()
+        self._tracker.remove_drop_listener(self._forget)
+        self._tracker = None
+        self._sampled.clear()
+        self._thread_trackers.clear()
+
+
+class ImportHookBackend(TracingBackend):
+    """Backend which wraps the functions & methods of `packages` rather than hooking every call.
+
+    Packages are named as in `InclusionRules`, e.g. "mycompany.*" or "sklearn.svm",
+    and are wrapped as they're imported, or straight away if they already were.
+    Everything outside of them runs at full speed with no per-call hook. Calls are
+    only recorded when made through a wrapper, so calls from the wrapped code back
+    into itself via captured references (e.g. closures) may be missed.
+
+    `call_stack_options` are passed on to the CallStack, e.g. to track asyncio Tasks.
+    """
+
+    def __init__(self, packages: Sequence[str], **call_stack_options):
+        self._hook = WrappingHook(packages)
+        self._call_stack: Optional[CallStack] = None
+        self._call_stack_options = call_stack_options
+
+    def start(self, tracker: NodeStack) -> None:
+        self.resume(tracker)
+
+    def pause(self) -> None:
+        """Leave the wrappers in place, but have them call straight through until `resume`."""
+        if self._hook.call_stack is not None:
+            self._hook.call_stack = None
+            self._call_stack.detach()
+
+    def resume(self, tracker: NodeStack) -> None:
+        if self._call_stack is None:
+            self._call_stack = CallStack(tracker, **self._call_stack_options)
+        self._hook.call_stack = self._call_stack
+        # Does nothing after a pause, but rewraps everything after a stop, e.g. within a forked worker.
+        self._hook.install()
+
+    def stop(self) -> None:
+        self._hook.uninstall()
+        self._hook.call_stack = None
+        if self._call_stack is not None:
+            self._call_stack.unwind()
+            self._call_stack = None
+
+
+def default_backend(**call_stack_options) -> TracingBackend:
+    if MonitoringBackend.supported():
+        return MonitoringBackend(**call_stack_options)
+    return SetTraceBackend(**call_stack_options)
@@ -0,0 +1,336 @@
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import dis
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Any, Mapping
+
+from sentiml.inclusion import module_verdict
+from sentiml.protocols import CodeProtocol, FrameProtocol
+from sentiml.stack_element import StackElement
+from sentiml.stack_trace import NodeStack
+from sentiml.throttle import ThrottlePolicy
+
+
+# Code => Offset of the instruction which a new call of it starts at, -1 before RESUME existed.
+_start_offsets: dict[CodeProtocol, int] = dict()
+
+
+def is_resuming(frame: FrameProtocol) -> bool:
+    """Whether `frame` is carrying on after a yield or await, rather than starting a new call."""
+    code = frame.f_code
+    try:
+        start = _start_offsets[code]
+    except KeyError:
+        start = _start_offsets[code] = next(
+            (instruction.offset for instruction in dis.get_instructions(code) if instruction.opname == "RESUME"), -1
+        )
+    return frame.f_lasti > start
+
+
+@dataclass
+class CallEntry:
+    # None for the entry a Task's stack is rooted on.
+    code: Optional[CodeProtocol]
+    depth: int
+    # Element recording this call, None if the NodeStack excluded it or the stack is too deep.
+    element: Optional[StackElement]
+    # Nearest element at or below this entry which was added to the NodeStack.
+    anchor: Optional[StackElement]
+    started_wall_ns: int = field(default=0)
+    started_cpu_ns: int = field(default=0)
+    # Inclusive time of timed entries directly above this one.
+    children_wall_ns: int = field(default=0)
+    children_cpu_ns: int = field(default=0)
+
+
+@dataclass
+class StackState:
+    """Shadow stack of a single thread, or of a single asyncio Task."""
+    tracker: NodeStack
+    entries: list[CallEntry] = field(default_factory=list)
+    # Task this state belongs to, None for a thread's own state.
+    task: Optional[Any] = field(default=None)
+    # Whether calls are recorded at all; unsampled tasks are skipped entirely.
+    recording: bool = field(default=True)
+    # id(Frame) => Entry of coroutines & generators which are suspended, when tracking Tasks.
+    # Abandoned frames may never resume, so their entries are dropped once a new call reuses the ID.
+    suspended: dict[int, CallEntry] = field(default_factory=dict)
+    # CallStack.detach count when this state was created, as returns made while detached were missed.
+    epoch: int = field(default=0)
+
+
+class CallStack:
+    """Per-thread shadow of the included frames on the interpreter stack.
+
+    Entries are pushed on call and popped on return, so the parent and depth of a
+    new element come from the top entry rather than from walking `f_back`. Frames
+    from excluded modules are never pushed, and entries hold code objects rather
+    than frames so nothing outlives the call it describes.
+
+    Each thread records into its own NodeStack from `NodeStack.for_thread`, so no
+    locking is needed while tracing.
+
+    With `asyncio_tasks`, every asyncio Task gets its own logical stack through a
+    context variable, rooted at the call its creator (the Task or thread whose context
+    it copied) was running when it first ran. A coroutine which
+    suspends and later resumes continues the node it started rather than being
+    recorded as a new call, and only `task_sample_rate` of the Tasks created
+    outside of another Task are recorded.
+
+    With a `throttle` policy, hot code objects stop being captured and their calls
+    are only counted against elements which were already captured.
+
+    Without `seed_running`, a thread's calls are recorded from the first call it
+    reports, rather than beneath the frames which were running at the time, e.g.
+    from the calls within a traced region.
+    """
+
+    def __init__(
+            self,
+            tracker: NodeStack,
+            asyncio_tasks: bool = False,
+            task_sample_rate: float = 1.0,
+            throttle: Optional[ThrottlePolicy] = None,
+    ):
+        self._tracker = tracker
+        self._throttle = throttle
+        self.seed_running = True
+        self._epoch = 0
+        if throttle is not None:
+            # Evicted elements may be freed, and their IDs reused by unrelated elements.
+            tracker.add_drop_listener(throttle.forget)
+        self._local = threading.local()
+        self._closed = False
+        self._asyncio_tasks = asyncio_tasks
+        self._task_sample_rate = task_sample_rate
+        # Separate from the program's own random numbers, which drawing from would change.
+        self._task_sampler = random.Random()
+        self._task_state: contextvars.ContextVar[Optional[StackState]] = contextvars.ContextVar(
+            f"sentiml_task_state_{id(self)}", default=None
+        )
+        # Top entry of the running thread or Task, copied into the context of every Task it creates.
+        self._top_entry: contextvars.ContextVar[Optional[CallEntry]] = contextvars.ContextVar(
+            f"sentiml_top_entry_{id(self)}", default=None
+        )
+
+    def close(self) -> None:
+        """Stop recording on every thread, for threads whose trace hooks can't be removed."""
+        self._closed = True
+        if self._throttle is not None:
+            self._tracker.remove_drop_listener(self._throttle.forget)
+
+    def _thread_state(self) -> Optional[StackState]:
+        state = getattr(self._local, 'state', None)
+        if state is not None and state.epoch != self._epoch:
+            # Detached since, so its calls may have returned unseen; they're closed, & the thread seeded again.
+            self._close_entries(state, record_time=False)
+            state = self._local.state = None
+        return state
+
+    def detach(self) -> None:
+        """Note that the hooks are being removed, until they report calls again, e.g. outside every traced region.
+
+        The running thread's entries are closed straight away. Every other thread's,
+        and every Task's, are closed the next time they report a call.
+        """
+        if (state := getattr(self._local, 'state', None)) is not None:
+            self._close_entries(state, record_time=True)
+            self._local.state = None
+        self._epoch += 1
+        self._task_state = contextvars.ContextVar(f"sentiml_task_state_{id(self)}_{self._epoch}", default=None)
+        self._top_entry = contextvars.ContextVar(f"sentiml_top_entry_{id(self)}_{self._epoch}", default=None)
+
+    def _close_entries(self, state: StackState, record_time: bool) -> None:
+        """Complete every suspended & open entry of `state`, innermost first."""
+        # Suspended entries were timed when they suspended.
+        suspended, state.suspended = state.suspended, dict()
+        closing = [entry for entry in suspended.values() if entry.element is not None]
+        while state.entries:
+            entry = state.entries.pop()
+            if entry.element is not None:
+                if record_time:
+                    self._record_time(state, entry)
+                closing.append(entry)
+        for entry in closing:
+            canonical = state.tracker.complete(entry.element)
+            if canonical is not entry.element and self._throttle is not None:
+                self._throttle.replace(entry.element, canonical)
+
+    def _new_task_state(self, task: Any) -> StackState:
+        # The Task's context was copied from whichever code created it.
+        creator = self._task_state.get()
+        if creator is None:
+            creator = self._thread_state()
+            recording = self._task_sample_rate >= 1.0 or self._task_sampler.random() < self._task_sample_rate
+        else:
+            recording = creator.recording
+        state = StackState(creator.tracker, task=task, recording=recording)
+        # The call the creator was running when the Task was created, rather than when it first ran.
+        if (top := self._top_entry.get()) is not None:
+            # Root the Task's calls beneath that call; this entry is never popped.
+            state.entries.append(CallEntry(None, top.depth, None, top.anchor))
+        self._task_state.set(state)
+        return state
+
+    def _state(self) -> Optional[StackState]:
+        thread_state = self._thread_state()
+        if self._asyncio_tasks and thread_state is not None:
+            loop = asyncio._get_running_loop()
+            if loop is not None and (task := asyncio.current_task(loop)) is not None:
+                state = self._task_state.get()
+                if state is None or state.task is not task:
+                    state = self._new_task_state(task)
+                return state
+        return thread_state
+
+    def is_seeded(self) -> bool:
+        return self._thread_state() is not None
+
+    def seed(self, frame: Optional[FrameProtocol]) -> list[FrameProtocol]:
+        """Push the included frames which were already running when this thread was first seen.
+
+        Returns the frames which were pushed, outermost first.
+        """
+        # A thread keeps recording into the same stack however many times it's seeded.
+        if (tracker := getattr(self._local, 'tracker', None)) is None:
+            thread = threading.current_thread()
+            tracker = self._local.tracker = self._tracker.for_thread(thread.name, thread)
+        self._local.state = StackState(tracker, epoch=self._epoch)
+        frames = []
+        while frame is not None:
+            if module_verdict(frame.f_code)[1]:
+                frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        for frame in frames:
+            self.enter(frame)
+        return frames
+
+    def enter(self, frame: FrameProtocol) -> bool:
+        """Push `frame` if its module is included, returning whether it was pushed."""
+        if self._closed or not module_verdict(frame.f_code)[1]:
+            return False
+        if not self.is_seeded():
+            self.seed(frame.f_back if self.seed_running else None)
+        state = self._state()
+        if not state.recording:
+            return False
+        entry = state.suspended.pop(id(frame), None) if len(state.suspended) > 0 else None
+        if entry is not None and entry.code is frame.f_code and is_resuming(frame):
+            # A coroutine or generator carrying on with the call it already recorded.
+            entry.children_wall_ns = entry.children_cpu_ns = 0
+        else:
+            if entry is not None and entry.element is not None:
+                # A new frame at the address of one which was abandoned while suspended.
+                state.tracker.complete(entry.element)
+            entry = self._new_entry(state, frame.f_code, frame, None, self._throttle)
+        self._push(state, entry)
+        return True
+
+    def enter_call(self, code: CodeProtocol, arguments: dict[str, Any]) -> bool:
+        """Push a call of `code` which is reported directly rather than by a frame, e.g. by a wrapper.
+
+        Only such calls are pushed on a thread which wasn't seeded from its frames.
+        """
+        if self._closed or not module_verdict(code)[1]:
+            return False
+        if not self.is_seeded():
+            self.seed(None)
+        state = self._state()
+        if not state.recording:
+            return False
+        self._push(state, self._new_entry(state, code, None, arguments, self._throttle))
+        return True
+
+    def _push(self, state: StackState, entry: CallEntry) -> None:
+        if entry.element is not None:
+            entry.started_wall_ns = time.perf_counter_ns()
+            entry.started_cpu_ns = time.thread_time_ns()
+        state.entries.append(entry)
+        if self._asyncio_tasks:
+            self._top_entry.set(entry)
+
+    @staticmethod
+    def _new_entry(
+            state: StackState,
+            code: CodeProtocol,
+            frame: Optional[FrameProtocol],
+            arguments: Optional[Mapping[str, Any]],
+            throttle: Optional[ThrottlePolicy],
+    ) -> CallEntry:
+        """Entry for a call of `code`, whose arguments are read from `frame` if given, only when captured."""
+        tracker = state.tracker
+        top = state.entries[-1] if len(state.entries) > 0 else None
+        depth = top.depth + 1 if top is not None else 1
+        anchor = top.anchor if top is not None else None
+        element = None
+        if depth <= tracker.max_depth:
+            if throttle is not None and throttle.is_throttled(code):
+                if (element := throttle.counted_element(anchor, code)) is not None:
+                    tracker.count_call(element)
+                elif (element := throttle.uncaptured_element(anchor, code, depth)) is not None:
+                    # e.g. the first call beneath each iteration of a loop, once the code was throttled.
+                    if (element := tracker.add_node(element)) is not None:
+                        throttle.count_against(anchor, code, element)
+            elif (element := tracker.repeat_call(anchor, code)) is None:
+                started_ns = time.perf_counter_ns() if throttle is not None else 0
+                if frame is not None:
+                    arguments = frame.f_locals
+                element = tracker.add_node(StackElement.from_arguments(code, arguments, parent=anchor, depth=depth))
+                if throttle is not None:
+                    throttle.record_capture(anchor, code, element, time.perf_counter_ns() - started_ns)
+            if element is not None:
+                tracker.open_call(element)
+                anchor = element
+        return CallEntry(code, depth, element, anchor)
+
+    def is_disabled(self, code: CodeProtocol) -> bool:
+        """Whether `code` has been throttled, and its events may be turned off entirely."""
+        return self._throttle is not None and self._throttle.is_disabled(code)
+
+    @staticmethod
+    def _record_time(state: StackState, entry: CallEntry) -> None:
+        wall_ns = time.perf_counter_ns() - entry.started_wall_ns
+        cpu_ns = time.thread_time_ns() - entry.started_cpu_ns
+        state.tracker.add_time(
+            entry.element, wall_ns, cpu_ns, wall_ns - entry.children_wall_ns, cpu_ns - entry.children_cpu_ns
+        )
+        # Time in entries without an element stays exclusive to the nearest element below them.
+        for parent_entry in reversed(state.entries):
+            if parent_entry.element is not None:
+                parent_entry.children_wall_ns += wall_ns
+                parent_entry.children_cpu_ns += cpu_ns
+                break
+
+    def exit(self, code: CodeProtocol, suspended_frame: Optional[FrameProtocol] = None) -> None:
+        """Pop the entry for `code`, keeping it for `suspended_frame` if the frame is only suspending."""
+        state = self._state()
+        # Returns from frames which were running before tracing started are ignored.
+        if state is not None and state.entries and state.entries[-1].code is code and not self._closed:
+            entry = state.entries.pop()
+            if self._asyncio_tasks:
+                self._top_entry.set(state.entries[-1] if state.entries else None)
+            if entry.element is not None:
+                self._record_time(state, entry)
+            if suspended_frame is not None and self._asyncio_tasks:
+                state.suspended[id(suspended_frame)] = entry
+            elif entry.element is not None:
+                canonical = state.tracker.complete(entry.element)
+                if canonical is not entry.element and self._throttle is not None:
+                    self._throttle.replace(entry.element, canonical)
+
+    def unwind(self) -> None:
+        """Close every entry still open on this thread, e.g. the frames which started tracing."""
+        state = self._thread_state()
+        while state is not None and state.entries:
+            self.exit(state.entries[-1].code)
+        self.close()
+
+    @property
+    def tracks_tasks(self) -> bool:
+        return self._asyncio_tasks
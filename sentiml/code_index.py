@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import gc
+import inspect
+from types import FunctionType
+from typing import Optional, Any, Iterator
+
+from sentiml.protocols import CodeProtocol
+
+# Code Object => Signature of the function that owns it, None if it couldn't be resolved.
+_signatures: dict[CodeProtocol, Optional[inspect.Signature]] = dict()
+
+
+def _candidates(attribute: Any) -> Iterator[Any]:
+    if isinstance(attribute, (staticmethod, classmethod)):
+        attribute = attribute.__func__
+    if isinstance(attribute, property):
+        yield from (attribute.fget, attribute.fset, attribute.fdel)
+        return None
+    # Follow functools.wraps chains down to the function which actually owns the code.
+    for _ in range(16):
+        if attribute is None:
+            return None
+        yield attribute
+        attribute = getattr(attribute, '__wrapped__', None)
+
+
+def _attribute_names(klass: type, name: str) -> Iterator[str]:
+    yield name
+    if name.startswith("__") and not name.endswith("__"):
+        yield f"_{klass.__name__.lstrip('_')}{name}"
+
+
+def _function_from_owner(code: CodeProtocol, owner: Any) -> Optional[FunctionType]:
+    klass = owner if isinstance(owner, type) else type(owner)
+    for base in getattr(klass, '__mro__', ()):
+        for attribute_name in _attribute_names(base, code.co_name):
+            for candidate in _candidates(base.__dict__.get(attribute_name)):
+                if isinstance(candidate, FunctionType) and candidate.__code__ is code:
+                    return candidate
+    return None
+
+
+def _function_from_referrers(code: CodeProtocol) -> Optional[FunctionType]:
+    for referrer in gc.get_referrers(code):
+        if isinstance(referrer, FunctionType) and referrer.__code__ is code:
+            return referrer
+    return None
+
+
+def signature_for_code(code: CodeProtocol, owner: Any = None) -> Optional[inspect.Signature]:
+    """Signature of the function which owns `code`, resolved at most once per code object.
+
+    The class of `owner` (the `self` or `cls` argument) is searched first, which is a
+    handful of dict lookups; scanning every GC-tracked object is only the fallback.
+    """
+    try:
+        return _signatures[code]
+    except KeyError:
+        pass
+    function = _function_from_owner(code, owner) if owner is not None else None
+    if function is None:
+        function = _function_from_referrers(code)
+    try:
+        signature = inspect.signature(function) if function is not None else None
+    except (ValueError, TypeError):
+        signature = None
+    _signatures[code] = signature
+    return signature
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pathlib
+import site
+import sys
+from importlib.metadata import distributions
+from typing import Optional
+
+# Top-level Module Name => Version of the distribution which installed it.
+_module_versions: Optional[dict[str, str]] = None
+
+
+def _cache_dir() -> pathlib.Path:
+    return pathlib.Path.home() / ".stack_traces" / "environments"
+
+
+def _site_packages() -> list[str]:
+    paths = list(getattr(site, 'getsitepackages', lambda: [])())
+    if site.ENABLE_USER_SITE and (user_site := site.getusersitepackages()) is not None:
+        paths.append(user_site)
+    return paths
+
+
+def _environment_key() -> str:
+    """Identifies the interpreter & prefix, whose caches replace one another."""
+    return hashlib.sha1(f"{sys.prefix}\n{sys.version}".encode()).hexdigest()[:16]
+
+
+def fingerprint() -> str:
+    """Identifies the installed distributions, changing whenever a package is (un)installed.
+
+    Only site-packages directories are considered; the working & script directories
+    change whenever a file is written to them, which doesn't change what's installed.
+    """
+    parts = []
+    for path in _site_packages():
+        try:
+            parts.append(f"{path}:{os.stat(path).st_mtime_ns}")
+        except OSError:
+            continue
+    installed = hashlib.sha1("\n".join(parts).encode()).hexdigest()
+    return f"{_environment_key()}-{installed}"
+
+
+def _top_level_modules(distribution) -> list[str]:
+    if (top_level := distribution.read_text('top_level.txt')) is not None:
+        return top_level.split()
+    modules = set()
+    for file in distribution.files or ():
+        root = file.parts[0]
+        if root.endswith(".py"):
+            modules.add(root[:-len(".py")])
+        elif "." not in root and not root.startswith("__"):
+            modules.add(root)
+        elif file.suffix in (".so", ".pyd") and len(file.parts) == 1:
+            modules.add(root.partition(".")[0])
+    return list(modules)
+
+
+def _scan_module_versions() -> dict[str, str]:
+    module_versions = dict()
+    for distribution in distributions():
+        for module in _top_level_modules(distribution):
+            # Earlier entries on sys.path shadow later ones, as they do for imports.
+            module_versions.setdefault(module, distribution.version)
+    return module_versions
+
+
+def module_versions() -> dict[str, str]:
+    """Version of every installed top-level module, from a single pass over the installed distributions.
+
+    The result is cached on disk under the environment's fingerprint, so that it's
+    only computed once per environment rather than once per run.
+    """
+    global _module_versions
+    if _module_versions is not None:
+        return _module_versions
+    cache_path = _cache_dir() / f"{fingerprint()}.json"
+    try:
+        with open(cache_path) as f:
+            _module_versions = json.load(f)
+        return _module_versions
+    except (OSError, ValueError):
+        pass
+    _module_versions = _scan_module_versions()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(temporary_path, 'w') as f:
+        json.dump(_module_versions, f)
+    # Concurrent workers may be writing the same cache.
+    os.replace(temporary_path, cache_path)
+    # Caches of this environment from before packages were last (un)installed.
+    for stale_path in cache_path.parent.glob(f"{_environment_key()}-*.json"):
+        if stale_path != cache_path:
+            stale_path.unlink(missing_ok=True)
+    return _module_versions
+
+
+def loaded_module_versions() -> dict[str, str]:
+    """Versions of the installed top-level modules which have been imported."""
+    versions = module_versions()
+    loaded = {name.partition(".")[0] for name in list(sys.modules)}
+    return {module: versions[module] for module in sorted(loaded) if module in versions}
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import json
+import pathlib
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Iterator, Any
+
+# Record kinds, the first item of every record.
+NODE_RECORD = "n"  # [n, node id, module, name, qualname, filename, first line, caller name, readable caller name, docs, signature]
+CALL_RECORD = "c"  # [c, call index, parent call index, node id, depth, arguments, tracked argument ids]
+TIME_RECORD = "t"  # [t, call index, wall ns, cpu ns, self wall ns, self cpu ns]
+
+
+@dataclass(frozen=True)
+class RecordedCode:
+    """Stand-in for the code object of a call which was read back from an event log."""
+    co_name: str
+    co_qualname: str
+    co_filename: str
+    co_firstlineno: int
+
+
+class EventLog:
+    """Append-only log segment of the nodes & calls recorded by a NodeStack.
+
+    Records are handed to a background thread which writes them in batches, and
+    every batch is flushed so the log survives the process dying.
+    """
+    SUFFIX = ".events"
+
+    def __init__(self, path: pathlib.Path, batch_size: int = 1024, flush_interval: float = 1.0):
+        self.path = path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._records: queue.SimpleQueue = queue.SimpleQueue()
+        self._closed = object()
+        self._writer = threading.Thread(target=self._write, name="sentiml-event-log", daemon=True)
+        self._writer.start()
+
+    @classmethod
+    def next_segment(cls, root_dir: pathlib.Path) -> EventLog:
+        segment = len(list(root_dir.glob(f"*{cls.SUFFIX}")))
+        return EventLog(root_dir / f"{segment:05d}{cls.SUFFIX}")
+
+    def write(self, record: list[Any]) -> None:
+        self._records.put(record)
+
+    def _write(self) -> None:
+        with open(self.path, "a") as f:
+            closed = False
+            while not closed:
+                batch = []
+                try:
+                    record = self._records.get(timeout=self._flush_interval)
+                    while True:
+                        if record is self._closed:
+                            closed = True
+                            break
+                        batch.append(json.dumps(record, separators=(",", ":"), default=str) + "\n")
+                        if len(batch) >= self._batch_size:
+                            break
+                        record = self._records.get_nowait()
+                except queue.Empty:
+                    pass
+                if len(batch) > 0:
+                    f.writelines(batch)
+                    f.flush()
+
+    def close(self) -> None:
+        self._records.put(self._closed)
+        self._writer.join()
+
+    @staticmethod
+    def read(path: pathlib.Path) -> Iterator[list[Any]]:
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # The final record of a log whose process died mid-write.
+                    return None
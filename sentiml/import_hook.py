@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import functools
+import importlib.abc
+import inspect
+import sys
+import threading
+import weakref
+from types import FunctionType, ModuleType
+from typing import Optional, Any, Callable, Sequence
+
+from sentiml.call_stack import CallStack
+from sentiml.inclusion import _compile, should_include_module, should_include_code
+from sentiml.protocols import CodeProtocol
+
+_CO_VARARGS = inspect.CO_VARARGS
+_CO_VARKEYWORDS = inspect.CO_VARKEYWORDS
+_CO_GENERATORS = inspect.CO_GENERATOR | inspect.CO_ASYNC_GENERATOR
+
+
+def _call_arguments(code: CodeProtocol, args: tuple, kwargs: dict[str, Any]) -> dict[str, Any]:
+    """Local names of `code` mapped to the arguments of a call, as `f_locals` would hold them on entry."""
+    names = code.co_varnames
+    positional_count = code.co_argcount
+    named_count = positional_count + code.co_kwonlyargcount
+    arguments = dict(zip(names[:positional_count], args))
+    next_name = named_count
+    if code.co_flags & _CO_VARARGS:
+        arguments[names[next_name]] = args[positional_count:]
+        next_name += 1
+    if kwargs:
+        named = names[:named_count]
+        extra = dict()
+        for name, value in kwargs.items():
+            if name in named:
+                arguments[name] = value
+            else:
+                extra[name] = value
+        if code.co_flags & _CO_VARKEYWORDS:
+            arguments[names[next_name]] = extra
+    return arguments
+
+
+class WrappingHook:
+    """Records calls of functions & methods in selected packages by replacing them with wrappers.
+
+    Modules are wrapped as they're imported, through a `sys.meta_path` finder, and
+    modules which were already imported are wrapped when the hook is installed.
+    Only functions and methods defined in a module which `should_include_module`,
+    and which `should_include_code`, are wrapped, so everything else (e.g. NumPy or
+    torch internals) runs without any hook at all. Coroutine functions are wrapped
+    by coroutine functions, recorded until the coroutine finishes, and properties
+    by properties with their getter, setter & deleter wrapped. Generator
+    functions are left unwrapped, as their callers run between each of their yields.
+
+    Wrappers record into `call_stack` while it's set, and otherwise call straight
+    through, so they can be left in place while paused and in references taken
+    with `from module import function`.
+    """
+
+    def __init__(self, packages: Sequence[str]):
+        self._packages = _compile(list(packages))
+        self.call_stack: Optional[CallStack] = None
+        self._local = threading.local()
+        self._finder: Optional[WrappingFinder] = None
+        # (Owner, Attribute Name, Original Attribute) for every attribute replaced by a wrapper.
+        self._replaced: list[tuple[Any, str, Any]] = list()
+        self._wrapped_classes: weakref.WeakSet[type] = weakref.WeakSet()
+        self._lock = threading.RLock()
+
+    def selects(self, module_name: str) -> bool:
+        return (
+                self._packages is not None
+                and self._packages.match(module_name) is not None
+                and should_include_module(module_name)
+        )
+
+    def install(self) -> None:
+        if self._finder is not None:
+            return None
+        self._finder = WrappingFinder(self)
+        sys.meta_path.insert(0, self._finder)
+        for module_name, module in list(sys.modules.items()):
+            if isinstance(module, ModuleType) and self.selects(module_name):
+                self.wrap_module(module)
+
+    def uninstall(self) -> None:
+        if self._finder is None:
+            return None
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+        self._finder = None
+        with self._lock:
+            for owner, name, original in reversed(self._replaced):
+                setattr(owner, name, original)
+            self._replaced = list()
+            self._wrapped_classes = weakref.WeakSet()
+
+    def wrap_module(self, module: ModuleType) -> None:
+        module_name = module.__name__
+        with self._lock:
+            for name, attribute in list(vars(module).items()):
+                if isinstance(attribute, type) and attribute.__module__ == module_name:
+                    self._wrap_class(attribute, module_name)
+                elif (wrapped := self._wrapped_attribute(attribute, module_name)) is not None:
+                    self._replace(module, name, attribute, wrapped)
+
+    def _wrap_class(self, klass: type, module_name: str) -> None:
+        if klass in self._wrapped_classes:
+            return None
+        self._wrapped_classes.add(klass)
+        for name, attribute in list(klass.__dict__.items()):
+            if isinstance(attribute, type) and attribute.__module__ == module_name:
+                self._wrap_class(attribute, module_name)
+            elif (wrapped := self._wrapped_attribute(attribute, module_name)) is not None:
+                self._replace(klass, name, attribute, wrapped)
+
+    def _replace(self, owner: Any, name: str, original: Any, wrapped: Any) -> None:
+        try:
+            setattr(owner, name, wrapped)
+        except (AttributeError, TypeError):
+            return None
+        self._replaced.append((owner, name, original))
+
+    def _wrapped_attribute(self, attribute: Any, module_name: str) -> Optional[Any]:
+        """`attribute` with its function wrapped, or None if it isn't an included function from `module_name`."""
+        if isinstance(attribute, (staticmethod, classmethod)):
+            if (function := self._wrapped_function(attribute.__func__, module_name)) is not None:
+                return type(attribute)(function)
+            return None
+        if type(attribute) is property:
+            accessors = [attribute.fget, attribute.fset, attribute.fdel]
+            wrapped = [self._wrapped_function(accessor, module_name) for accessor in accessors]
+            if all(function is None for function in wrapped):
+                return None
+            return property(
+                *(function or accessor for function, accessor in zip(wrapped, accessors)),
+                doc=attribute.__doc__,
+            )
+        return self._wrapped_function(attribute, module_name)
+
+    def _wrapped_function(self, function: Any, module_name: str) -> Optional[Callable]:
+        if (
+                not isinstance(function, FunctionType)
+                or hasattr(function, '__sentiml_wrapped__')
+                or function.__module__ != module_name
+                or not should_include_code(function.__code__, module_name)
+                # Their callers run between each yield, which a wrapper can't keep apart from the generator's own calls.
+                or function.__code__.co_flags & _CO_GENERATORS
+        ):
+            return None
+        return self._wrap(function)
+
+    def _wrap(self, function: FunctionType) -> Callable:
+        hook = self
+        local = self._local
+        code = function.__code__
+
+        def enter(args: tuple, kwargs: dict[str, Any]) -> Optional[CallStack]:
+            """Push this call, returning the CallStack to pop it from, or None if it isn't recorded."""
+            call_stack = hook.call_stack
+            if call_stack is None or getattr(local, 'recording', False):
+                return None
+            # Calls made while capturing this one, e.g. by a summarizer, aren't recorded.
+            local.recording = True
+            try:
+                entered = call_stack.enter_call(code, _call_arguments(code, args, kwargs))
+            finally:
+                local.recording = False
+            return call_stack if entered else None
+
+        if inspect.iscoroutinefunction(function):
+            # Awaited through, so the call stays open until the coroutine finishes rather than once it's created.
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if (call_stack := enter(args, kwargs)) is None:
+                    return await function(*args, **kwargs)
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    call_stack.exit(code)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if (call_stack := enter(args, kwargs)) is None:
+                    return function(*args, **kwargs)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    call_stack.exit(code)
+
+        wrapper.__sentiml_wrapped__ = function
+        return wrapper
+
+
+class WrappingLoader(importlib.abc.Loader):
+    """Runs a module with its original loader, then wraps the functions it defined."""
+
+    def __init__(self, hook: WrappingHook, loader: importlib.abc.Loader):
+        self._hook = hook
+        self._loader = loader
+
+    def create_module(self, spec) -> Optional[ModuleType]:
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module: ModuleType) -> None:
+        self._loader.exec_module(module)
+        self._hook.wrap_module(module)
+
+    def __getattr__(self, name: str) -> Any:
+        # e.g. get_source & get_code, used by inspect and linecache.
+        return getattr(self._loader, name)
+
+
+class WrappingFinder(importlib.abc.MetaPathFinder):
+    """Finds selected modules through the rest of `sys.meta_path` and wraps their loader."""
+
+    def __init__(self, hook: WrappingHook):
+        self._hook = hook
+        self._local = threading.local()
+
+    def find_spec(self, fullname: str, path=None, target=None):
+        if getattr(self._local, 'finding', False) or not self._hook.selects(fullname):
+            return None
+        self._local.finding = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._local.finding = False
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        spec.loader = WrappingLoader(self._hook, spec.loader)
+        return spec
@@ -1,12 +1,162 @@
-from typing import Optional
+from __future__ import annotations
+
+import fnmatch
+import functools
+import inspect
+import os
+import re
+from dataclasses import dataclass
+from typing import Optional, Pattern
 
 from sentiml.default_libraries import DEFAULT_LIBS, DEV_LIBS, LIBS_THAT_ARENT_RELEVANT
+from sentiml.protocols import CodeProtocol
+
+# Comma separated rules, read when sentiml is imported & whenever tracking starts without rules of its own.
+INCLUDE_VARIABLE = "SENTIML_INCLUDE"
+EXCLUDE_VARIABLE = "SENTIML_EXCLUDE"
+EXCLUDE_FUNCTIONS_VARIABLE = "SENTIML_EXCLUDE_FUNCTIONS"
+
+
+def _rule_pattern(rule: str) -> str:
+    """A glob if `rule` has wildcards, otherwise the named module or function and everything within it."""
+    if any(wildcard in rule for wildcard in "*?["):
+        return fnmatch.translate(rule)
+    return re.escape(rule) + r"(?:\..*)?\Z"
+
+
+def _compile(rules: list[str]) -> Optional[Pattern]:
+    if len(rules) == 0:
+        return None
+    return re.compile("|".join(f"(?:{_rule_pattern(rule)})" for rule in rules))
+
+
+@dataclass(frozen=True)
+class InclusionRules:
+    """Which modules & functions are traced.
+
+    `include` is an allowlist of modules: when it's given, only matching modules
+    are traced. `exclude` removes modules and `exclude_functions` removes functions,
+    matched against "module.QualName". A rule is either a glob, e.g. "mycompany.*",
+    or a dotted name which matches itself and everything beneath it, e.g. "sklearn.svm".
+    With `defaults`, the standard library & libraries in `default_libraries` are
+    excluded too, along with dunder methods other than `__init__` & `__call__`.
+    """
+    include: tuple[str, ...] = ()
+    exclude: tuple[str, ...] = ()
+    exclude_functions: tuple[str, ...] = ()
+    defaults: bool = True
+
+    @staticmethod
+    def _environment_rules(variable: str) -> tuple[str, ...]:
+        return tuple(rule.strip() for rule in os.environ.get(variable, "").split(",") if rule.strip())
+
+    @classmethod
+    def from_environment(cls) -> InclusionRules:
+        return InclusionRules(
+            include=cls._environment_rules(INCLUDE_VARIABLE),
+            exclude=cls._environment_rules(EXCLUDE_VARIABLE),
+            exclude_functions=cls._environment_rules(EXCLUDE_FUNCTIONS_VARIABLE),
+        )
+
+    def compile(self) -> CompiledRules:
+        excluded_modules = list(self.exclude)
+        excluded_functions = list(self.exclude_functions)
+        if self.defaults:
+            excluded_modules.extend(DEFAULT_LIBS)
+            excluded_modules.extend(DEV_LIBS)
+            # Irrelevant libraries are excluded wherever they appear, as the name of a function too.
+            irrelevant = [f"*{lib}*" for lib in LIBS_THAT_ARENT_RELEVANT]
+            excluded_modules.extend(irrelevant)
+            excluded_functions.extend(irrelevant)
+        return CompiledRules(
+            included_modules=_compile(list(self.include)),
+            excluded_modules=_compile(excluded_modules),
+            excluded_functions=_compile(excluded_functions),
+            exclude_dunders=self.defaults,
+        )
+
+
+@dataclass(frozen=True)
+class CompiledRules:
+    included_modules: Optional[Pattern]
+    excluded_modules: Optional[Pattern]
+    excluded_functions: Optional[Pattern]
+    exclude_dunders: bool
 
+    def includes_module(self, module: str) -> bool:
+        if self.included_modules is not None and self.included_modules.match(module) is None:
+            return False
+        return self.excluded_modules is None or self.excluded_modules.match(module) is None
 
+    def includes_function(self, module: str, code: CodeProtocol) -> bool:
+        name = code.co_name
+        if self.exclude_dunders and name.startswith("__") and name not in ("__init__", "__call__"):
+            return False
+        if self.excluded_functions is None:
+            return True
+        qualname = getattr(code, 'co_qualname', name)
+        return (
+                self.excluded_functions.match(f"{module}.{qualname}") is None
+                and self.excluded_functions.match(f"{module}.{name}") is None
+        )
+
+
+_rules_source = InclusionRules.from_environment()
+_rules = _rules_source.compile()
+
+# co_filename => (Module Name, Verdict)
+_module_verdicts: dict[str, tuple[Optional[str], bool]] = dict()
+# Code => Verdict
+_code_verdicts: dict[CodeProtocol, bool] = dict()
+
+
+def use_rules(rules: InclusionRules) -> None:
+    """Trace according to `rules` from now on, rather than the rules from the environment."""
+    global _rules, _rules_source
+    if rules == _rules_source:
+        return None
+    _rules_source = rules
+    _rules = rules.compile()
+    clear_inclusion_cache()
+
+
+@functools.lru_cache(maxsize=None)
 def should_include_module(module: Optional[str]) -> bool:
     return (module is not None
             and module != "UnknownModule"
-            and next(iter(module.split("."))) not in DEFAULT_LIBS
-            and next(iter(module.split("."))) not in DEV_LIBS
-            and not any([lib in module for lib in LIBS_THAT_ARENT_RELEVANT])
+            and _rules.includes_module(module)
             )
+
+
+def module_verdict(code: CodeProtocol) -> tuple[Optional[str], bool]:
+    """Name of the module `code` was defined in, and whether that module is included.
+
+    `inspect.getmodule` resolves a code object purely from its filename, so the
+    answer is cached per `co_filename` and only the first call per file pays for it.
+    """
+    try:
+        return _module_verdicts[code.co_filename]
+    except KeyError:
+        module = inspect.getmodule(code)
+        module_name = module.__name__ if hasattr(module, '__name__') else None
+        verdict = _module_verdicts[code.co_filename] = (module_name, should_include_module(module_name))
+        return verdict
+
+
+def should_include_code(code: CodeProtocol, module: Optional[str]) -> bool:
+    """Whether calls of `code`, from `module`, are recorded, cached per code object."""
+    try:
+        return _code_verdicts[code]
+    except KeyError:
+        verdict = _code_verdicts[code] = (
+                should_include_module(module)
+                and code.co_name is not None
+                and _rules.includes_function(module, code)
+        )
+        return verdict
+
+
+def clear_inclusion_cache() -> None:
+    _module_verdicts.clear()
+    _code_verdicts.clear()
+    should_include_module.cache_clear()
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+from sentiml.stack_element import StackElement
+from sentiml.summaries import Summary
+
+
+@dataclass(frozen=True)
+class StackLimits:
+    """Bounds on the memory a NodeStack holds, so tracing can stay on in a long-running process.
+
+    Once a stack holds more than `max_nodes` nodes, or an estimated `max_bytes`,
+    the least recently hit subtrees are evicted until it's back under `low_water`
+    of each limit. With `rotate_interval` (seconds) or `rotate_nodes`, the stack
+    is dumped into a new trace segment and reset whenever that much time has
+    passed, or that many nodes were added, since it was last rotated.
+
+    Subtrees with a call still running are never evicted or reset, as calls are
+    still being added beneath them. Each thread's stack is bounded separately,
+    and the stacks of threads which have exited are folded together, within the
+    same bounds.
+    """
+    max_nodes: Optional[int] = None
+    max_bytes: Optional[int] = None
+    low_water: float = 0.75
+    rotate_interval: Optional[float] = None
+    rotate_nodes: Optional[int] = None
+
+    def over_limits(self, nodes: int, node_bytes: int) -> bool:
+        return (
+                (self.max_nodes is not None and nodes > self.max_nodes)
+                or (self.max_bytes is not None and node_bytes > self.max_bytes)
+        )
+
+    def under_low_water(self, nodes: int, node_bytes: int) -> bool:
+        return (
+                (self.max_nodes is None or nodes <= self.max_nodes * self.low_water)
+                and (self.max_bytes is None or node_bytes <= self.max_bytes * self.low_water)
+        )
+
+    def rotation_due(self, added_nodes: int, elapsed: float) -> bool:
+        return (
+                (self.rotate_nodes is not None and added_nodes >= self.rotate_nodes)
+                or (self.rotate_interval is not None and elapsed >= self.rotate_interval)
+        )
+
+
+def estimated_bytes(node: StackElement) -> int:
+    """Rough size of `node` and of the values captured for it, excluding the metadata shared with other nodes."""
+    size = sys.getsizeof(node) + sys.getsizeof(node.children)
+    if node.argument_values is not None:
+        size += sys.getsizeof(node.argument_values)
+        for value in node.argument_values.values():
+            size += sys.getsizeof(value)
+            if isinstance(value, Summary):
+                size += sys.getsizeof(value.fields)
+    if node.tracked_argument_ids is not None:
+        size += sys.getsizeof(node.tracked_argument_ids)
+    return size
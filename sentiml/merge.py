@@ -0,0 +1,70 @@
+import pathlib
+import shutil
+import sys
+import uuid
+from typing import Optional
+
+from sentiml.archive import TraceArchive
+from sentiml.rebuild import rebuild_trace
+from sentiml.trace_id import TraceID
+from sentiml.tracking_type import TrackingType
+
+MERGED_MARKER = ".merged"
+FLAMEGRAPHS = ["flamegraph.txt", "flamegraph-cpu.txt"]
+
+
+def _append_trace(source: pathlib.Path, target: pathlib.Path, shard: str) -> None:
+    if not source.exists():
+        return None
+    with open(source, encoding="utf-8") as shard_trace, open(target, "a", encoding="utf-8") as f:
+        for line in shard_trace:
+            if line.startswith("[0]"):
+                line = f"{line.rstrip()} (process: {shard})\n"
+            f.write(line)
+
+
+def _append_flamegraph(source: pathlib.Path, target: pathlib.Path) -> None:
+    if source.exists():
+        with open(source) as shard_graph, open(target, "a") as f:
+            shutil.copyfileobj(shard_graph, f)
+
+
+def merge_shard(shard_dir: pathlib.Path) -> None:
+    TraceID.use_shard(shard_dir.name)
+    try:
+        # Workers which streamed their stacks have only written event logs.
+        rebuild_trace()
+    finally:
+        TraceID.use_shard(None)
+    if (shard_dir / TraceArchive.FILENAME).exists():
+        # A worker killed part way through its dump can leave an archive without any tables.
+        TraceArchive(shard_dir / TraceArchive.FILENAME).close()
+        with TraceArchive.for_run() as archive:
+            archive.merge(shard_dir / TraceArchive.FILENAME)
+    for stack_type in TrackingType:
+        stack_dir = TraceID.root_dir() / str(stack_type)
+        shard_stack_dir = shard_dir / str(stack_type)
+        if shard_stack_dir.exists():
+            stack_dir.mkdir(exist_ok=True)
+            _append_trace(shard_stack_dir / "trace.txt", stack_dir / "trace.txt", shard_dir.name)
+            for flamegraph in FLAMEGRAPHS:
+                _append_flamegraph(shard_stack_dir / flamegraph, stack_dir / flamegraph)
+    if (shard_dir / "classes").exists():
+        shutil.copytree(shard_dir / "classes", TraceID.root_dir() / "classes", dirs_exist_ok=True)
+    (shard_dir / MERGED_MARKER).touch()
+
+
+def merge_shards(trace_id: Optional[uuid.UUID] = None) -> None:
+    """Combine the shards written by worker processes into the run's own archive and traces."""
+    if trace_id is not None:
+        TraceID.use(trace_id)
+    TraceID.use_shard(None)
+    if not TraceID.shards_dir().exists():
+        return None
+    for shard_dir in sorted(TraceID.shards_dir().iterdir()):
+        if shard_dir.is_dir() and not (shard_dir / MERGED_MARKER).exists():
+            merge_shard(shard_dir)
+
+
+if __name__ == "__main__":
+    merge_shards(uuid.UUID(sys.argv[1]))
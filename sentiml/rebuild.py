@@ -0,0 +1,22 @@
+import sys
+import uuid
+from typing import Optional
+
+from sentiml.event_log import EventLog
+from sentiml.stack_trace import NodeStack
+from sentiml.trace_id import TraceID
+from sentiml.tracking_type import TrackingType
+
+
+def rebuild_trace(trace_id: Optional[uuid.UUID] = None, aggregate: bool = False) -> None:
+    """Rebuild & dump every streamed NodeStack of a run, by default the current one."""
+    if trace_id is not None:
+        TraceID.use(trace_id)
+    for stack_type in TrackingType:
+        segments = sorted((TraceID.root_dir() / str(stack_type)).glob(f"*{EventLog.SUFFIX}"))
+        if len(segments) > 0:
+            NodeStack.from_event_log(stack_type, segments, aggregate=aggregate).dump()
+
+
+if __name__ == "__main__":
+    rebuild_trace(uuid.UUID(sys.argv[1]), aggregate="--aggregate" in sys.argv[2:])
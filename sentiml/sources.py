@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import hashlib
+import inspect
+import linecache
+from dataclasses import dataclass
+from typing import Optional
+
+from sentiml.protocols import CodeProtocol
+
+
+@dataclass(frozen=True)
+class SourceLocation:
+    """Lines of a source file, identified by the hash of the file's contents."""
+    file_hash: str
+    first_line: int
+    last_line: int
+
+    def _json_repr(self) -> dict:
+        return {"file_hash": self.file_hash, "first_line": self.first_line, "last_line": self.last_line}
+
+
+@dataclass(frozen=True)
+class SourceFile:
+    file_hash: str
+    filename: str
+    lines: tuple[str, ...]
+
+    def text(self, location: Optional[SourceLocation] = None) -> str:
+        if location is None:
+            return "".join(self.lines)
+        return "".join(self.lines[location.first_line - 1:location.last_line])
+
+
+# Filename => SourceFile, None if the file couldn't be read.
+_files: dict[str, Optional[SourceFile]] = dict()
+# File Hash => SourceFile
+_files_by_hash: dict[str, SourceFile] = dict()
+# (Filename, First Line, Name) => SourceLocation, None if the code has no source.
+_locations: dict[tuple[str, int, str], Optional[SourceLocation]] = dict()
+
+
+def source_file(filename: str) -> Optional[SourceFile]:
+    """Contents of `filename`, read & hashed once per run."""
+    try:
+        return _files[filename]
+    except KeyError:
+        pass
+    lines = linecache.getlines(filename)
+    file = None
+    if len(lines) > 0:
+        text = "".join(lines)
+        file_hash = hashlib.sha1(text.encode("utf-8", "surrogateescape")).hexdigest()
+        file = _files_by_hash.setdefault(file_hash, SourceFile(file_hash, filename, tuple(lines)))
+    _files[filename] = file
+    return file
+
+
+def source_location(code: CodeProtocol) -> Optional[SourceLocation]:
+    """Where the source of `code` is, without re-reading or re-tokenizing files already seen.
+
+    Also works for stand-ins such as `RecordedCode` which only know their name & position.
+    """
+    key = (code.co_filename, code.co_firstlineno, code.co_name)
+    try:
+        return _locations[key]
+    except KeyError:
+        pass
+    location = None
+    file = source_file(code.co_filename)
+    if file is not None and 0 < code.co_firstlineno <= len(file.lines):
+        if code.co_name == "<module>":
+            last_line = len(file.lines)
+        else:
+            try:
+                block = inspect.getblock(file.lines[code.co_firstlineno - 1:])
+            except BaseException:
+                block = file.lines[code.co_firstlineno - 1:code.co_firstlineno]
+            last_line = code.co_firstlineno + len(block) - 1
+        location = SourceLocation(file.file_hash, code.co_firstlineno, last_line)
+    _locations[key] = location
+    return location
+
+
+def source_text(code: CodeProtocol) -> Optional[str]:
+    """Memoized equivalent of `inspect.getsource(code)`, None where there's no source."""
+    location = source_location(code)
+    if location is None:
+        return None
+    return file_for(location.file_hash).text(location)
+
+
+def file_for(file_hash: str) -> SourceFile:
+    return _files_by_hash[file_hash]
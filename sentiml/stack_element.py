@@ -1,19 +1,16 @@
 from __future__ import annotations
 
-import functools
-import uuid
-import gc
 import inspect
 import json
-import operator
-import sys
 from dataclasses import field, dataclass
-from types import FunctionType
-from typing import Optional, List, TextIO
+from typing import Optional, Sequence, TextIO, Any, Mapping
 
-from sentiml.inclusion import should_include_module
+from sentiml.code_index import signature_for_code
+from sentiml.inclusion import module_verdict
 from sentiml.protocols import CodeProtocol, FrameProtocol
 from sentiml.slugify import slugify
+from sentiml.sources import source_location
+from sentiml.summaries import summarize
 
 class NotIncludedError(BaseException):
     pass
@@ -30,37 +27,145 @@ def get_caller_name(argument) -> Optional[str]:
         elif hasattr(argument.__class__, '__name__') and getattr(argument.__class__, '__name__') is not None:
             return argument.__class__.__name__
 
-@dataclass
-class StackElement:
+@dataclass(slots=True, eq=False)
+class CodeInfo:
+    """Static metadata shared by every call of a code object on the same kind of caller."""
     description: CodeProtocol
     module: str
-    parent: Optional[StackElement] = field(default=None)
-    signature: Optional[str] = field(default=None)
-    argument_values: dict[str, str] = field(default_factory=dict)
-    tracked_argument_ids: dict[str, str] = field(default_factory=dict)
+    signature: Optional[inspect.Signature] = field(default=None)
     caller_name: Optional[str] = field(default=None)
     readable_caller_name: Optional[str] = field(default=None)
     caller_docs: Optional[str] = field(default=None)
-    children: List[StackElement] = field(default_factory=list)
-    _hash: Optional[int] = field(default=None)
+    # Summarized default values of the signature's parameters, merged beneath each call's arguments.
+    defaults: Optional[dict[str, Any]] = field(default=None)
+
+    @staticmethod
+    def _describe_caller(info: CodeInfo, caller: Any) -> None:
+        try:
+            if hasattr(caller, '__qualname__'):
+                info.caller_name = caller.__qualname__
+            elif hasattr(caller, '__name__'):
+                info.caller_name = caller.__name__
+            if info.readable_caller_name is None:
+                info.readable_caller_name = get_caller_name(caller)
+            if hasattr(caller, '__doc__') and getattr(caller, '__doc__') is not None:
+                info.caller_docs = caller.__doc__
+        except BaseException:
+            pass
+
+    @staticmethod
+    def for_call(code: CodeProtocol, module: str, callers: list[Any]) -> CodeInfo:
+        """Interned CodeInfo for a call of `code`, where `callers` are its `self`/`cls` arguments."""
+        owner = callers[-1] if len(callers) > 0 else None
+        key = (code, owner if owner is None or isinstance(owner, type) else type(owner))
+        try:
+            return _code_infos[key]
+        except KeyError:
+            pass
+        info = CodeInfo(description=code, module=module)
+        for caller in callers:
+            CodeInfo._describe_caller(info, caller)
+        if owner is not None and (signature := signature_for_code(code, owner)) is not None:
+            info.signature = signature
+            info.defaults = {
+                k: summarize(v.default)
+                for k, v in signature.parameters.items()
+                if v.default is not inspect.Parameter.empty
+            } or None
+        _code_infos[key] = info
+        return info
+
+
+# (Code, Caller Class) => CodeInfo
+_code_infos: dict[tuple[CodeProtocol, Optional[type]], CodeInfo] = dict()
+
+
+@dataclass(slots=True, eq=False)
+class StackElement:
+    info: CodeInfo
+    parent: Optional[StackElement] = field(default=None)
+    # Per-call captured values, None rather than an empty dict when nothing was captured.
+    # Values are summaries from `summarize`, only formatted by `str` when dumped.
+    argument_values: Optional[dict[str, Any]] = field(default=None)
+    tracked_argument_ids: Optional[dict[str, str]] = field(default=None)
+    # Shared empty tuple until the first child is added.
+    children: Sequence[StackElement] = field(default=())
+    depth: int = field(default=1)
+    samples: int = field(default=0)
+    calls: int = field(default=1)
+    # Indices of the first and most recent calls recorded against this element within its NodeStack.
+    first_seen: int = field(default=0)
+    last_seen: int = field(default=0)
+    # Inclusive & exclusive (self_) time spent in calls recorded against this element.
+    wall_ns: int = field(default=0)
+    self_wall_ns: int = field(default=0)
+    cpu_ns: int = field(default=0)
+    self_cpu_ns: int = field(default=0)
+    # Name of the thread the call was made on, set once the thread's stack has been merged, or from the event log.
+    thread: Optional[str] = field(default=None)
+    # Order-aware digest of this element's code & its children's digests, set once its subtree is complete.
+    content_hash: Optional[bytes] = field(default=None)
+    # Calls recorded against this element which haven't returned yet.
+    open_calls: int = field(default=0)
+
+    @property
+    def description(self) -> CodeProtocol:
+        return self.info.description
+
+    @property
+    def module(self) -> str:
+        return self.info.module
+
+    @property
+    def signature(self) -> Optional[inspect.Signature]:
+        return self.info.signature
+
+    @property
+    def caller_name(self) -> Optional[str]:
+        return self.info.caller_name
+
+    @property
+    def readable_caller_name(self) -> Optional[str]:
+        return self.info.readable_caller_name
+
+    @property
+    def caller_docs(self) -> Optional[str]:
+        return self.info.caller_docs
 
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        # Subtrees are only equal once complete, when their content can no longer change.
+        if self is other:
+            return True
+        if not isinstance(other, StackElement) or self.content_hash is None:
+            return False
+        return self.content_hash == other.content_hash
 
     def _json_repr(self) -> dict:
-        try:
-            source = inspect.getsource(self.description)
-        except BaseException:
-            source = None
+        source = source_location(self.description)
         return {
-            "arguments": self.argument_values,
-            "tracked_argument_ids": self.tracked_argument_ids,
+            "arguments": self.formatted_arguments(),
+            "tracked_argument_ids": self.tracked_argument_ids or {},
             "signature": f"def {self.description.co_name}{self.signature}" if self.signature is not None else "",
             "caller_name": self.readable_caller_name,
             "caller_docs": self.caller_docs,
-            "source": source
+            "samples": self.samples,
+            "calls": self.calls,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "wall_ns": self.wall_ns,
+            "self_wall_ns": self.self_wall_ns,
+            "cpu_ns": self.cpu_ns,
+            "self_cpu_ns": self.self_cpu_ns,
+            "thread": self.thread,
+            "content_hash": self.content_hash.hex() if self.content_hash is not None else None,
+            "source": source._json_repr() if source is not None else None,
         }
 
+    def formatted_arguments(self) -> dict[str, str]:
+        if self.argument_values is None:
+            return {}
+        return {name: str(value) for name, value in self.argument_values.items()}
+
     def dumps(self, file: TextIO) -> None:
         json.dump(self._json_repr(), file)
 
@@ -71,87 +176,91 @@ class StackElement:
             return slugify(f"{self.module}.{self.description.co_name}")
 
     def __hash__(self) -> int:
-        if self._hash is not None:
-            return self._hash
-        self._hash = hash(self.description) + functools.reduce(
-            operator.add, map(hash, self.children), 0
-        )
-        return hash(self)
+        # Consistent with __eq__, since equal content implies the same code.
+        return hash(self.description)
+
+    def merge(self, other: StackElement) -> set[int]:
+        """Add the calls & time of `other`, a complete subtree with the same content, into this one.
+
+        Returns the IDs of the nodes within `other` which were merged away.
+        """
+        merged = set()
+        pairs = [(self, other)]
+        while len(pairs) > 0:
+            node, duplicate = pairs.pop()
+            if id(duplicate) in merged or node is duplicate:
+                continue
+            merged.add(id(duplicate))
+            node.calls += duplicate.calls
+            node.samples += duplicate.samples
+            node.last_seen = max(node.last_seen, duplicate.last_seen)
+            node.add_time(duplicate.wall_ns, duplicate.cpu_ns, duplicate.self_wall_ns, duplicate.self_cpu_ns)
+            pairs.extend(zip(node.children, duplicate.children))
+        return merged
+
+    def add_time(self, wall_ns: int, cpu_ns: int, self_wall_ns: int, self_cpu_ns: int) -> None:
+        self.wall_ns += wall_ns
+        self.cpu_ns += cpu_ns
+        self.self_wall_ns += self_wall_ns
+        self.self_cpu_ns += self_cpu_ns
+
+    def self_samples(self) -> int:
+        return self.samples - sum(child.samples for child in self.children)
 
     def add_child(self, child: StackElement) -> None:
-        self.children.append(child)
+        if len(self.children) == 0:
+            self.children = [child]
+        else:
+            self.children.append(child)
 
     def __str__(self) -> str:
         return f"{self.module}.{self.description.co_name}"
 
     @staticmethod
-    @functools.lru_cache(maxsize=2**8)
-    def from_frame(frame: FrameProtocol) -> StackElement:
-        module = inspect.getmodule(frame.f_code)
-        if not should_include_module(module.__name__ if hasattr(module, '__name__') else None):
+    def from_frame(frame: FrameProtocol, parent: Optional[StackElement] = None, depth: int = 1) -> StackElement:
+        return StackElement.from_arguments(frame.f_code, frame.f_locals, parent=parent, depth=depth)
+
+    @staticmethod
+    def from_arguments(
+            code: CodeProtocol,
+            arguments: Mapping[str, Any],
+            parent: Optional[StackElement] = None,
+            depth: int = 1,
+    ) -> StackElement:
+        """Element for a call of `code`, where `arguments` maps its local names to their values."""
+        module_name, included = module_verdict(code)
+        if not included:
             raise NotIncludedError
-        if frame.f_back is not None:
-            parent = StackElement.from_frame(frame.f_back)
-        else:
-            parent = None
 
-        possible_argument_names = frame.f_code.co_varnames
         argument_values = {}
         tracked_argument_ids = {}
-        readable_caller_name = None
-        caller_name = None
-        caller_docs = None
-        signature = None
-        for argument_name in possible_argument_names:
-            if argument_name in frame.f_locals:
-                argument_value = frame.f_locals[argument_name]
+        callers = []
+        for argument_name in code.co_varnames:
+            if argument_name in arguments:
+                argument_value = arguments[argument_name]
                 # Present after track_class is called on the class.
                 try:
                     if (tracked_argument_id := getattr(argument_value, '__observer_class_name__', None)) is not None:
-                        tracked_argument_ids[argument_name] = tracked_argument_id
+                        tracked_argument_ids[argument_name] = str(tracked_argument_id)
                 except RecursionError:
                     try:
                         if (tracked_argument_id := argument_value.get('__observer_class_name__', None)) is not None:
-                            tracked_argument_ids[argument_name] = tracked_argument_id
+                            tracked_argument_ids[argument_name] = str(tracked_argument_id)
                     except BaseException:
                         continue
                 if argument_name in ['self', 'cls']:
-                    try:
-                        if hasattr(argument_value, '__qualname__'):
-                            caller_name = argument_value.__qualname__
-                        elif hasattr(argument_value, '__name__'):
-                            caller_name = argument_value.__name__
-                        if readable_caller_name is None:
-                            readable_caller_name = get_caller_name(argument_value)                        
-                        if hasattr(argument_value, '__doc__') and getattr(argument_value, '__doc__') is not None:
-                            caller_docs = argument_value.__doc__
-                    except BaseException:
-                        pass
-                if sys.getsizeof(argument_value) < 512:
-                    try:
-                        argument_values[argument_name] = str(argument_value)
-                    except BaseException:
-                        pass
-        if 'self' in argument_values or 'cls' in argument_values:
-            referents = list(gc.get_referrers(frame.f_code))
-            if len(referents) > 0:
-                initial_referent = next(iter(referents))
-                if isinstance(initial_referent, FunctionType):
-                    signature = inspect.signature(initial_referent)
-                    argument_values =  {
-                        k: v.default if v.default is not inspect.Parameter.empty else None
-                        for k, v in signature.parameters.items()
-                        if v.default is not inspect.Parameter.empty
-                    } | argument_values
+                    callers.append(argument_value)
+                argument_values[argument_name] = summarize(argument_value)
+        info = CodeInfo.for_call(
+            code, module_name if module_name is not None else "UnknownModule", callers
+        )
+        if info.defaults is not None:
+            argument_values = info.defaults | argument_values
 
         return StackElement(
-            description=frame.f_code,
-            module=module.__name__ if module is not None else "UnknownModule",
+            info=info,
             parent=parent,
-            signature=signature,
-            argument_values=argument_values,
-            tracked_argument_ids={k: str(v) for (k, v) in tracked_argument_ids.items()},
-            caller_name=caller_name,
-            readable_caller_name=readable_caller_name,
-            caller_docs=caller_docs,
+            depth=depth,
+            argument_values=argument_values or None,
+            tracked_argument_ids=tracked_argument_ids or None,
         )
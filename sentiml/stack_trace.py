@@ -1,73 +1,506 @@
 from __future__ import annotations
 
-import inspect
-import operator
+import hashlib
+import itertools
 import pathlib
+import sys
+import threading
+import time
+from collections import Counter
 from dataclasses import dataclass
-from functools import reduce
-from typing import Optional
+from typing import Optional, Callable, Iterator, Sequence, Union
 
-from sentiml.default_libraries import (
-    LIBS_THAT_ARENT_RELEVANT,
-)
-from sentiml.inclusion import should_include_module
+from sentiml.archive import TraceArchive
+from sentiml.event_log import EventLog, RecordedCode, NODE_RECORD, CALL_RECORD, TIME_RECORD
+from sentiml.inclusion import should_include_code, module_verdict
+from sentiml.limits import StackLimits, estimated_bytes
 from sentiml.protocols import CodeProtocol
-from sentiml.stack_element import StackElement
+from sentiml.slugify import slugify
+from sentiml.sources import source_text
+from sentiml.stack_element import StackElement, CodeInfo
 from sentiml.trace_id import TraceID
 from sentiml.tracking_type import TrackingType
 
 
+MAIN_THREAD = threading.main_thread().name
+
+
 class NodeStack:
-    def __init__(self, stack_type: TrackingType, existing_node_ids: Optional[list[int]] = None, max_depth: int = 6):
+    def __init__(
+            self,
+            stack_type: TrackingType,
+            existing_node_ids: Optional[list[int]] = None,
+            max_depth: int = 6,
+            aggregate: bool = False,
+            limits: Optional[StackLimits] = None,
+    ):
         if existing_node_ids is None:
             self._existing_node_ids: list[int] = []
         else:
             self._existing_node_ids = existing_node_ids
         self._stack_type: TrackingType = stack_type
         self._nodes: list[StackElement] = list()
-        self._node_lookup: dict[int, StackElement] = dict()  # Node Hash => Node
         self._max_node_depth = max_depth
+        # Merge repeated calls along the same call path into a single node.
+        self.aggregate = aggregate
+        # (Parent ID, Code, Thread) => Node
+        self._aggregated: dict[tuple[int, CodeProtocol, Optional[str]], StackElement] = dict()
+        self._call_index = 0
+        # Set while streaming, in which case calls are written to the log instead of being kept.
+        self._event_log: Optional[EventLog] = None
+        self._logged_nodes: dict[CodeInfo, int] = dict()  # CodeInfo => Node ID
+        self._log_lock = threading.Lock()
+        self._call_counter = itertools.count()
+        # id(Parent) => Content Hash => Child, the first complete occurrence of each distinct subtree.
+        self._canonical: dict[int, dict[bytes, StackElement]] = dict()
+        self._info_digests: dict[CodeInfo, bytes] = dict()
+        # Stacks filled by individual threads, merged into this one at dump.
+        self.thread_name: Optional[str] = None
+        # Thread the stack records, if known, so the stack can be folded into this one once the thread exits.
+        self._thread: Optional[threading.Thread] = None
+        self._thread_stacks: list[NodeStack] = list()
+        self._threads_lock = threading.Lock()
+        # Bounds on the nodes kept in memory, checked whenever a call returns.
+        self.limits = limits
+        self._node_count = 0
+        # Estimated, and only counted with a byte limit.
+        self._node_bytes = 0
+        self._added_since_rotation = 0
+        self._rotated_at = time.monotonic()
+        self._segment = 0
+        # Called with the IDs of the nodes each eviction or rotation drops, shared with every thread's stack.
+        self._drop_listeners: list[Callable[[frozenset[int]], None]] = list()
 
     def _include_node(self, node: StackElement) -> bool:
-        is_included = (
+        return (
                 node is not None
-                and should_include_module(node.module)
-                and node.description.co_name is not None
-                and not any([lib in f"{node.module}.{node.description.co_name}" for lib in LIBS_THAT_ARENT_RELEVANT])
-                and (
-                        node.description.co_name in ["__init__", "__call__"]
-                        or not node.description.co_name.startswith("__")
-                )
+                and should_include_code(node.description, node.module)
                 and NodeStack.node_depth(node) <= self._max_node_depth
         )
-        return is_included
-
-    @staticmethod
-    def _node_depth(node: Optional[StackElement], depth: int = 0) -> int:
-        if node is None:
-            return depth
-        return NodeStack._node_depth(node.parent, depth + 1)
 
     @staticmethod
     def node_depth(node: StackElement) -> int:
-        return NodeStack._node_depth(node, 0)
+        return node.depth
+
+    @property
+    def max_depth(self) -> int:
+        return self._max_node_depth
+
+    def _record_call(self, node: StackElement) -> None:
+        node.calls += 1
+        node.last_seen = self._call_index
+        self._call_index += 1
+
+    def count_call(self, node: StackElement) -> None:
+        """Count another call against `node` without capturing it, e.g. for throttled code."""
+        self._record_call(node)
+
+    def add_sample(self, node: StackElement) -> None:
+        """Count a sample which landed in `node`, which is a hit as far as eviction is concerned."""
+        node.samples += 1
+        node.last_seen = self._call_index
+        self._call_index += 1
 
-    def add_node(self, node: StackElement) -> None:
+    def add_drop_listener(self, listener: Callable[[frozenset[int]], None]) -> None:
+        """Call `listener` with the IDs of the nodes dropped by each eviction or rotation, e.g. to forget them."""
+        self._drop_listeners.append(listener)
+
+    def remove_drop_listener(self, listener: Callable[[frozenset[int]], None]) -> None:
+        if listener in self._drop_listeners:
+            self._drop_listeners.remove(listener)
+
+    def repeat_call(self, parent: Optional[StackElement], code: CodeProtocol) -> Optional[StackElement]:
+        """When aggregating, count a call to `code` beneath `parent` against an existing node.
+
+        Returns the node the call was counted against, if there was one, so the caller
+        can avoid building a StackElement for it.
+        """
+        if not self.aggregate or self.is_streaming():
+            return None
+        # Calls recorded live are on this stack's own thread, and only noted on each node at merge.
+        node = self._aggregated.get((id(parent), code, None))
+        if node is not None:
+            self._record_call(node)
+        return node
+
+    def add_node(self, node: StackElement) -> Optional[StackElement]:
+        """Add `node` beneath its parent, which must already be part of this stack.
+
+        Returns the node which represents the call within the stack, which is an
+        existing node when aggregating, or None if the node was excluded.
+        """
         if not self._include_node(node):
             return None
-        self._node_lookup[hash(node)] = node
+        if self.is_streaming():
+            self._log_call(node)
+            return node
+        if self.aggregate:
+            key = (id(node.parent), node.description, node.thread)
+            if (existing_node := self._aggregated.get(key)) is not None:
+                self._record_call(existing_node)
+                return existing_node
+            self._aggregated[key] = node
+        node.first_seen = node.last_seen = self._call_index
+        self._call_index += 1
+        if self.limits is not None:
+            self._node_count += 1
+            self._added_since_rotation += 1
+            if self.limits.max_bytes is not None:
+                self._node_bytes += estimated_bytes(node)
         if node.parent is None:
             self._nodes.append(node)
         else:
-            try:
-                node_parent = self._node_lookup[hash(node.parent)]
-                node_parent.add_child(node)
-            except KeyError:
-                while node.parent is not None and (not self._include_node(node.parent)):
-                    # Keep searching up the tree until a valid parent is found.
-                    node.parent = node.parent.parent
-                self.add_node(node.parent)
-                self.add_node(node)
+            node.parent.add_child(node)
+        return node
+
+    def _info_digest(self, info: CodeInfo) -> bytes:
+        try:
+            return self._info_digests[info]
+        except KeyError:
+            code = info.description
+            key = "\0".join(map(str, (
+                info.module, getattr(code, 'co_qualname', code.co_name), code.co_filename, code.co_firstlineno,
+                info.caller_name,
+            )))
+            digest = self._info_digests[info] = hashlib.blake2b(key.encode(), digest_size=16).digest()
+            return digest
+
+    def _canonicalize(self, node: StackElement) -> StackElement:
+        """Content hash `node`, whose children are complete, returning the identical node it merged into if any."""
+        if self.aggregate or self.is_streaming() or node.content_hash is not None:
+            return node
+        digest = hashlib.blake2b(self._info_digest(node.info), digest_size=16)
+        if node.parent is None and node.thread is not None:
+            # Roots of different threads, e.g. rebuilt from an event log, aren't shared.
+            digest.update(node.thread.encode())
+        for child in node.children:
+            if child.content_hash is None:
+                # e.g. a coroutine which is still suspended.
+                return node
+            digest.update(child.content_hash)
+        node.content_hash = digest.digest()
+        siblings = self._canonical.setdefault(id(node.parent), dict())
+        canonical = siblings.setdefault(node.content_hash, node)
+        if canonical is not node:
+            for merged_id in canonical.merge(node):
+                self._canonical.pop(merged_id, None)
+        return canonical
+
+    def open_call(self, node: StackElement) -> None:
+        """Note that a call recorded against `node` is running, until it's passed to `complete`."""
+        node.open_calls += 1
+
+    def complete(self, node: StackElement) -> StackElement:
+        """Note that the call recorded by `node` has returned, so its subtree can no longer change.
+
+        The subtree is content hashed, and if an identical subtree already completed
+        beneath the same parent, `node` is merged into it and replaced by a reference
+        to it. Repeated work, such as the same step of every batch, is then kept once.
+        Returns whichever node now represents the call.
+        """
+        if node.open_calls > 0:
+            node.open_calls -= 1
+        canonical = self._canonicalize(node)
+        if canonical is not node:
+            references = self._nodes if node.parent is None else node.parent.children
+            # The node is almost always the most recent child.
+            for i in range(len(references) - 1, -1, -1):
+                if references[i] is node:
+                    references[i] = canonical
+                    break
+        # Between calls is the one point where every running call is known to be open.
+        self.check_limits()
+        return canonical
+
+    def _complete_tree(self, running: frozenset[int] = frozenset()) -> None:
+        """Complete every subtree which never returned, e.g. those rebuilt from an event log.
+
+        Nodes in `running` (by ID) are left incomplete, as calls are still being added beneath them.
+        """
+        if self.aggregate:
+            return None
+        expanded = set()
+        pending = [(node, False) for node in self._nodes]
+        while len(pending) > 0:
+            node, children_expanded = pending.pop()
+            if children_expanded:
+                for i, child in enumerate(node.children):
+                    if id(child) not in running:
+                        node.children[i] = self._canonicalize(child)
+            elif node.content_hash is None and id(node) not in expanded:
+                expanded.add(id(node))
+                pending.append((node, True))
+                pending.extend((child, False) for child in node.children)
+        for i, node in enumerate(self._nodes):
+            if id(node) not in running:
+                self._nodes[i] = self._canonicalize(node)
+
+    def check_limits(self) -> None:
+        """Rotate, or evict down to the low water mark, if the limits call for it.
+
+        Called whenever a call completes, and by backends which never complete calls, e.g. sampling.
+        """
+        if self.limits is not None and not self.is_streaming():
+            self._apply_limits()
+
+    def _apply_limits(self) -> None:
+        limits = self.limits
+        if limits.rotation_due(self._added_since_rotation, time.monotonic() - self._rotated_at):
+            self.rotate()
+        elif limits.over_limits(self._node_count, self._node_bytes):
+            self._evict()
+
+    def _scan(self) -> tuple[dict[int, StackElement], dict[int, int], dict[int, int], frozenset[int]]:
+        """Scan the tree by node ID, for eviction & rotation.
+
+        Returns every distinct node, how many times each is referenced, the most recent
+        call within each node's subtree, and the subtrees with a call which hasn't returned.
+        """
+        nodes: dict[int, StackElement] = dict()
+        references: dict[int, int] = dict()
+        last_hit: dict[int, int] = dict()
+        running = set()
+        pending = [(node, False) for node in self._nodes]
+        while len(pending) > 0:
+            node, children_expanded = pending.pop()
+            node_id = id(node)
+            if children_expanded:
+                hit = node.last_seen
+                is_running = node.open_calls > 0
+                for child in node.children:
+                    hit = max(hit, last_hit[id(child)])
+                    is_running = is_running or id(child) in running
+                last_hit[node_id] = hit
+                if is_running:
+                    running.add(node_id)
+                continue
+            # Shared subtrees are repeated among the children of the same parent.
+            references[node_id] = references.get(node_id, 0) + 1
+            if node_id not in nodes:
+                nodes[node_id] = node
+                pending.append((node, True))
+                pending.extend((child, False) for child in node.children)
+        return nodes, references, last_hit, frozenset(running)
+
+    def _retain(self, nodes: dict[int, StackElement], references: dict[int, int], kept: set[int]) -> None:
+        """Drop every node other than those in `kept` (by ID), which includes the ancestors of each kept node."""
+        self._nodes = [node for node in self._nodes if id(node) in kept]
+        for node_id in kept:
+            node = nodes[node_id]
+            if len(node.children) > 0:
+                node.children = [child for child in node.children if id(child) in kept]
+        self._aggregated = {key: node for key, node in self._aggregated.items() if id(node) in kept}
+        self._canonical = {
+            parent_id: {digest: node for digest, node in siblings.items() if id(node) in kept}
+            for parent_id, siblings in self._canonical.items()
+            if parent_id in kept or parent_id == id(None)
+        }
+        self._node_count = sum(references[node_id] for node_id in kept)
+        if self.limits.max_bytes is not None:
+            self._node_bytes = sum(estimated_bytes(nodes[node_id]) for node_id in kept)
+        if len(self._drop_listeners) > 0:
+            dropped = frozenset(node_id for node_id in nodes if node_id not in kept)
+            for listener in list(self._drop_listeners):
+                listener(dropped)
+
+    def _evict(self) -> None:
+        """Evict the least recently hit subtrees which aren't running, until back under the low water mark."""
+        limits = self.limits
+        nodes, references, last_hit, running = self._scan()
+        node_bytes = {
+            node_id: estimated_bytes(node) if limits.max_bytes is not None else 0 for node_id, node in nodes.items()
+        }
+        count, total_bytes = sum(references.values()), sum(node_bytes.values())
+        evicted = set()
+        # Deeper subtrees first where they were hit as recently as their parent. Complete subtrees are only evicted
+        # whole, as their content hash, and any identical subtree merged into them, covers every child.
+        candidates = sorted(
+            (last_hit[node_id], -node.depth, node_id) for node_id, node in nodes.items()
+            if node_id not in running and (node.parent is None or node.parent.content_hash is None)
+        )
+        for _, _, node_id in candidates:
+            if limits.under_low_water(count, total_bytes):
+                break
+            remaining = [nodes[node_id]]
+            while len(remaining) > 0:
+                node = remaining.pop()
+                if id(node) not in evicted:
+                    evicted.add(id(node))
+                    count -= references[id(node)]
+                    total_bytes -= node_bytes[id(node)]
+                    remaining.extend(node.children)
+        self._retain(nodes, references, {node_id for node_id in nodes if node_id not in evicted})
+
+    def rotate(self) -> None:
+        """Dump the stack into a new trace segment, then drop every subtree which isn't running.
+
+        Running calls are carried over into the next segment, where calls beneath them keep being added.
+        """
+        nodes, references, _, running = self._scan()
+        if self.thread_name is not None:
+            for node in nodes.values():
+                node.thread = self.thread_name
+        self._complete_tree(running)
+        segment = f"{self._segment:05d}"
+        if self.thread_name is not None:
+            segment = f"{segment}-{slugify(self.thread_name)}"
+        segment_dir = self._root_dir() / "segments" / segment
+        segment_dir.mkdir(parents=True, exist_ok=True)
+        self._write(segment_dir)
+        self._segment += 1
+        self._added_since_rotation = 0
+        self._rotated_at = time.monotonic()
+        self._retain(nodes, references, set(running))
+
+    def add_time(self, node: StackElement, wall_ns: int, cpu_ns: int, self_wall_ns: int, self_cpu_ns: int) -> None:
+        node.add_time(wall_ns, cpu_ns, self_wall_ns, self_cpu_ns)
+        if self.is_streaming():
+            self._event_log.write([TIME_RECORD, node.first_seen, wall_ns, cpu_ns, self_wall_ns, self_cpu_ns])
+
+    def is_streaming(self) -> bool:
+        return self._event_log is not None
+
+    def stream(self) -> None:
+        """Write calls to a new event log segment rather than keeping them in memory.
+
+        The tree can be rebuilt from the log offline with `NodeStack.from_event_log`.
+        """
+        if self._event_log is None:
+            self._event_log = EventLog.next_segment(self._root_dir())
+            self._logged_nodes = dict()
+            self._call_counter = itertools.count()
+
+    def _log_node(self, node: StackElement) -> int:
+        try:
+            return self._logged_nodes[node.info]
+        except KeyError:
+            pass
+        # Every thread shares a streaming stack, so IDs have to be handed out one at a time.
+        with self._log_lock:
+            if (node_id := self._logged_nodes.get(node.info)) is not None:
+                return node_id
+            node_id = len(self._logged_nodes)
+            code = node.description
+            self._event_log.write([
+                NODE_RECORD, node_id, node.module, code.co_name, getattr(code, 'co_qualname', code.co_name),
+                code.co_filename, code.co_firstlineno, node.caller_name, node.readable_caller_name,
+                node.caller_docs, str(node.signature) if node.signature is not None else None,
+            ])
+            self._logged_nodes[node.info] = node_id
+            return node_id
+
+    def _log_call(self, node: StackElement) -> None:
+        node.first_seen = node.last_seen = next(self._call_counter)
+        # Every thread logs into the same stack, so each call notes the thread it was made on.
+        thread = node.thread if node.thread is not None else threading.current_thread().name
+        self._event_log.write([
+            CALL_RECORD, node.first_seen, node.parent.first_seen if node.parent is not None else None,
+            self._log_node(node), node.depth, node.argument_values, node.tracked_argument_ids, thread,
+        ])
+
+    @staticmethod
+    def from_event_log(stack_type: TrackingType, paths: list[pathlib.Path], aggregate: bool = False) -> NodeStack:
+        """Rebuild a NodeStack from streamed event log segments."""
+        stack = NodeStack(stack_type, aggregate=aggregate, max_depth=sys.maxsize)
+        for path in paths:
+            # Node IDs & call indices are only unique within a segment.
+            infos: dict[int, CodeInfo] = dict()
+            calls: dict[int, StackElement] = dict()
+            for record in EventLog.read(path):
+                if record[0] == NODE_RECORD:
+                    node_id, module, name, qualname, filename, first_line = record[1:7]
+                    caller_name, readable_caller_name, caller_docs, signature = record[7:]
+                    infos[node_id] = CodeInfo(
+                        description=RecordedCode(name, qualname, filename, first_line),
+                        module=module,
+                        signature=signature,
+                        caller_name=caller_name,
+                        readable_caller_name=readable_caller_name,
+                        caller_docs=caller_docs,
+                    )
+                elif record[0] == CALL_RECORD:
+                    call_index, parent_index, node_id, depth, arguments, tracked_argument_ids = record[1:7]
+                    node = stack.add_node(StackElement(
+                        info=infos[node_id],
+                        parent=calls.get(parent_index),
+                        depth=depth,
+                        argument_values=arguments,
+                        tracked_argument_ids=tracked_argument_ids,
+                        # Logs written before calls noted their thread have none.
+                        thread=record[7] if len(record) > 7 else None,
+                    ))
+                    if node is not None:
+                        calls[call_index] = node
+                elif record[0] == TIME_RECORD and (node := calls.get(record[1])) is not None:
+                    node.add_time(*record[2:])
+        return stack
+
+    def reset(self) -> None:
+        """Forget every recorded node, e.g. within a forked worker which inherited its parent's stack."""
+        self._nodes = list()
+        self._aggregated = dict()
+        self._canonical = dict()
+        self._thread_stacks = list()
+        self._call_index = 0
+        self._node_count = self._node_bytes = self._added_since_rotation = 0
+        self._rotated_at = time.monotonic()
+        if self._event_log is not None:
+            # The log's writer thread doesn't survive a fork, so start a new segment.
+            self._event_log = None
+            self.stream()
+
+    def for_thread(self, thread_name: str, thread: Optional[threading.Thread] = None) -> NodeStack:
+        """Stack for a single thread to record into without locking, merged into this one at dump.
+
+        With limits, the stacks of threads which have exited are folded into this one
+        as each new thread's stack is created, and bounded by the same limits.
+        """
+        if self.is_streaming():
+            return self
+        stack = NodeStack(
+            self._stack_type, max_depth=self._max_node_depth, aggregate=self.aggregate, limits=self.limits
+        )
+        stack.thread_name = thread_name
+        stack._thread = thread
+        stack._drop_listeners = self._drop_listeners
+        with self._threads_lock:
+            if self.limits is not None:
+                self._fold_exited_threads()
+            self._thread_stacks.append(stack)
+        return stack
+
+    def _fold_exited_threads(self) -> None:
+        """Fold the stacks of threads which have exited into this one, e.g. those of short-lived workers."""
+        exited = [stack for stack in self._thread_stacks if stack._thread is not None and not stack._thread.is_alive()]
+        if len(exited) == 0:
+            return None
+        self._thread_stacks = [stack for stack in self._thread_stacks if stack not in exited]
+        for stack in exited:
+            self._fold(stack, exited=True)
+        self.check_limits()
+
+    def _fold(self, stack: NodeStack, exited: bool = False) -> None:
+        """Move the nodes recorded by a thread's stack into this one, noting the thread on each node."""
+        stack.merge_threads()
+        remaining = list(stack._nodes)
+        while len(remaining) > 0:
+            node = remaining.pop()
+            node.thread = stack.thread_name
+            if exited:
+                # Calls of an exited thread which never returned, e.g. when it was seeded, can't still be running.
+                node.open_calls = 0
+            remaining.extend(node.children)
+        self._nodes.extend(stack._nodes)
+        self._node_count += stack._node_count
+        self._node_bytes += stack._node_bytes
+        self._added_since_rotation += stack._added_since_rotation
+
+    def merge_threads(self) -> None:
+        """Move the nodes recorded by each thread's stack into this one, noting the thread on each node."""
+        with self._threads_lock:
+            thread_stacks, self._thread_stacks = self._thread_stacks, list()
+        for stack in thread_stacks:
+            self._fold(stack)
 
     def _root_dir(self) -> pathlib.Path:
         root_dir = (
@@ -77,34 +510,114 @@ class NodeStack:
         root_dir.mkdir(parents=True, exist_ok=True)
         return root_dir
 
-    def _dump_node(self, node: StackElement) -> None:
-        target_node = self._root_dir() / node.name()
-        if not target_node.exists():
-            with open(target_node, "w") as f:
-                node.dumps(f)
-        for child_node in node.children:
-            self._dump_node(child_node)
+    def _unique_nodes(self) -> Iterator[StackElement]:
+        """Every node which would be stored separately in the archive, first occurrence only."""
+        seen = set()
+        visited = set()
+        remaining = list(reversed(self._nodes))
+        while len(remaining) > 0:
+            node = remaining.pop()
+            # Shared subtrees are referenced many times, but only need visiting once.
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            key = (node.name(), node.description.co_filename, node.description.co_firstlineno)
+            if key not in seen:
+                seen.add(key)
+                yield node
+            remaining.extend(reversed(node.children))
 
     def dump(self) -> None:
-        with open(self._root_dir() / 'trace.txt', 'w') as f:
+        if self.is_streaming():
+            self._event_log.close()
+            self._event_log = None
+            return None
+        self.merge_threads()
+        self._complete_tree()
+        self._write(self._root_dir())
+
+    def _write(self, directory: pathlib.Path) -> None:
+        with open(directory / 'trace.txt', 'w', encoding='utf-8') as f:
             f.writelines(self._write_stack())
-        for child_node in self._nodes:
-            self._dump_node(child_node)
+        self._write_flamegraph(directory / 'flamegraph.txt', lambda node: node.self_wall_ns // 1000)
+        self._write_flamegraph(directory / 'flamegraph-cpu.txt', lambda node: node.self_cpu_ns // 1000)
+        with TraceArchive.for_run() as archive:
+            archive.add_nodes(self._stack_type, self._unique_nodes())
         # TODO: Save all libraries within tracked Nodes.
 
-    def _write_node(self, node: StackElement, level: int = 0) -> list[str]:
-        trace = []
-        if level <= self._max_node_depth:
-            trace.append(f"[{level}]" + "".join(["\t" * (level + 1)]) + f"{node}\n")
-            previous_node = None
-            for child_node in node.children:
-                if child_node != previous_node:
-                    trace = trace + self._write_node(child_node, level + 1)
-                    previous_node = child_node
-        return trace
+    def _node_line(self, node: StackElement, level: int, occurrences: int = 1, repeats: int = 1) -> str:
+        # A shared node's calls are merged across each of its `occurrences` in the rendered tree,
+        # so each line shows its calls per occurrence, and the repetition multiplies them.
+        if node.calls % occurrences == 0:
+            calls_each = node.calls // occurrences
+            calls = f" [{calls_each} calls]" if calls_each > 1 else ""
+        else:
+            calls = f" [{node.calls} calls in total]"
+        samples = f" [{node.samples} samples]" if node.samples > 0 else ""
+        thread = f" (thread: {node.thread})" if level == 0 and node.thread not in (None, MAIN_THREAD) else ""
+        repeated = f" ×{repeats}" if repeats > 1 else ""
+        indent = "\t" * (level + 1)
+        return f"[{level}]{indent}{node}{calls}{samples}{thread}{repeated}\n"
+
+    def _write_siblings(
+            self, siblings: Sequence[StackElement], level: int, occurrences: int = 1
+    ) -> Iterator[Union[str, tuple[Sequence[StackElement], int, int]]]:
+        """Lines for `siblings`, and the children to write beneath each of them.
+
+        `occurrences` is how many times their parent appears in the fully expanded tree.
+        """
+        if level > self._max_node_depth:
+            return None
+        indent = "\t" * (level + 1)
+        references = Counter(id(sibling) for sibling in siblings)
+        for start, period, repeats in _repetitions(siblings):
+            if period > 1:
+                yield f"[{level}]{indent}×{repeats} of the next {period}:\n"
+            for node in siblings[start:start + period]:
+                node_occurrences = occurrences * references[id(node)]
+                yield self._node_line(node, level, node_occurrences, repeats if period == 1 else 1)
+                yield node.children, level + 1, node_occurrences
+
+    def _write_stack(self) -> Iterator[str]:
+        """Render trace.txt line by line, printing repeated runs of siblings once."""
+        pending = [self._write_siblings(self._nodes, 0)]
+        while len(pending) > 0:
+            item = next(pending[-1], None)
+            if item is None:
+                pending.pop()
+            elif isinstance(item, str):
+                yield item
+            else:
+                pending.append(self._write_siblings(*item))
+
+    def _collapse_node(
+            self,
+            node: StackElement,
+            path: list[str],
+            weight: Callable[[StackElement], int],
+            stacks: dict[str, int],
+    ) -> None:
+        path.append(str(node).replace(";", ":").replace(" ", "_"))
+        stack = ";".join(path)
+        stacks[stack] = stacks.get(stack, 0) + weight(node)
+        # Repeated subtrees are shared, and a shared node's stats already cover every reference to it.
+        for child_node in {id(child): child for child in node.children}.values():
+            self._collapse_node(child_node, path, weight, stacks)
+        path.pop()
+
+    def _write_flamegraph(self, path: pathlib.Path, weight: Callable[[StackElement], int]) -> None:
+        """Write the stack in collapsed-stack format, weighting each node by `weight`.
+
+        Samples are used instead when the stack was sampled rather than traced.
+        """
+        if any(node.samples > 0 for node in self._nodes):
+            weight = StackElement.self_samples
+        stacks: dict[str, int] = dict()
+        for node in self._nodes:
+            self._collapse_node(node, [], weight, stacks)
+        with open(path, 'w') as f:
+            f.writelines(f"{stack} {value}\n" for stack, value in stacks.items() if value > 0)
 
-    def _write_stack(self) -> list[str]:
-        return reduce(operator.add, [self._write_node(n) for n in self._nodes], [])
 
 
 @dataclass
@@ -118,13 +631,33 @@ class FnDescription:
 
     @staticmethod
     def from_code(code: CodeProtocol) -> FnDescription:
-        module = inspect.getmodule(code)
-        try:
-            src = inspect.getsource(code)
-        except OSError:
-            src = None
+        module_name, _ = module_verdict(code)
         return FnDescription(
-            module.__name__ if module is not None else "UnknownModule",
+            module_name if module_name is not None else "UnknownModule",
             code.co_name,
-            src,
+            source_text(code),
         )
+
+
+def _repetitions(siblings: Sequence[StackElement], max_period: int = 8) -> Iterator[tuple[int, int, int]]:
+    """Split `siblings` into runs of (start, period, repeats), where each run repeats its first `period` nodes.
+
+    The run covering the most siblings is taken at each position, preferring shorter periods.
+    """
+    # Equal siblings are the same node, or complete subtrees with the same content.
+    # Roots of different threads are kept apart, even with the same content.
+    keys = [(sibling.content_hash or id(sibling), sibling.thread) for sibling in siblings]
+    i = 0
+    while i < len(keys):
+        best_period, best_repeats = 1, 1
+        for period in range(1, min(max_period, (len(keys) - i) // 2) + 1):
+            if keys[i] != keys[i + period]:
+                continue
+            pattern = keys[i:i + period]
+            repeats = 1
+            while keys[i + repeats * period:i + (repeats + 1) * period] == pattern:
+                repeats += 1
+            if repeats > 1 and period * repeats > best_period * best_repeats:
+                best_period, best_repeats = period, repeats
+        yield i, best_period, best_repeats
+        i += best_period * best_repeats
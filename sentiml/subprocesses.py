@@ -0,0 +1,100 @@
+import atexit
+import dataclasses
+import json
+import multiprocessing.util
+import os
+import signal
+import threading
+from typing import Optional, Callable
+
+from sentiml.inclusion import InclusionRules
+from sentiml.trace_id import TraceID, TRACKING_TYPE_VARIABLE
+from sentiml.tracking_type import TrackingType
+
+# InclusionRules given in code, as JSON, which child processes would otherwise read from the environment.
+RULES_VARIABLE = "SENTIML_RULES"
+
+
+def export_tracking(tracking_type: Optional[TrackingType], rules: Optional[InclusionRules] = None) -> None:
+    """Pass the trace ID, the active TrackingType & its `rules` on to any child process started from now on.
+
+    With None, child processes started from now on are left to start runs of their own.
+    """
+    if tracking_type is None:
+        os.environ.pop(TraceID.ENVIRONMENT_VARIABLE, None)
+        os.environ.pop(TRACKING_TYPE_VARIABLE, None)
+        os.environ.pop(RULES_VARIABLE, None)
+        return None
+    os.environ[TraceID.ENVIRONMENT_VARIABLE] = str(TraceID.id())
+    os.environ[TRACKING_TYPE_VARIABLE] = tracking_type.name
+    if rules is None:
+        os.environ.pop(RULES_VARIABLE, None)
+    else:
+        os.environ[RULES_VARIABLE] = json.dumps(dataclasses.asdict(rules))
+
+
+def inherited_tracking() -> Optional[TrackingType]:
+    """TrackingType which was active in the parent when this process was started, if any."""
+    tracking_type = os.environ.get(TRACKING_TYPE_VARIABLE)
+    if tracking_type is None or tracking_type not in TrackingType.__members__:
+        return None
+    return TrackingType[tracking_type]
+
+
+def inherited_rules() -> Optional[InclusionRules]:
+    """InclusionRules which the parent was given in code, if any."""
+    if (rules := os.environ.get(RULES_VARIABLE)) is None:
+        return None
+    return InclusionRules(**{
+        name: tuple(value) if isinstance(value, list) else value for name, value in json.loads(rules).items()
+    })
+
+
+def become_worker() -> None:
+    """Direct everything this process writes to its own shard of the run."""
+    TraceID.use_shard(str(os.getpid()))
+
+
+def _stop_on_sigterm(stop: Callable[[], bool]) -> None:
+    """Call `stop` before the default handling of SIGTERM, e.g. from `Pool.terminate`."""
+    if threading.current_thread() is not threading.main_thread():
+        # Signal handlers can only be set from the main thread.
+        return None
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def on_sigterm(signum, frame):
+        if not stop():
+            # Interrupted the worker while it was already stopping on its way out, so let it finish.
+            return None
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            signal.signal(signum, previous if previous is not None else signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+
+def stop_on_exit(owner: type, stop: Callable[[], None]) -> None:
+    """Call `stop` when this worker exits, however it exits.
+
+    multiprocessing workers leave through `os._exit`, which skips atexit but runs
+    multiprocessing's own finalizers. Those are cleared when a worker bootstraps,
+    so the finalizer is registered from an after-fork hook, which runs afterwards.
+    Workers which are terminated, as every worker of a `with Pool(...)` block is,
+    get SIGTERM instead, so `stop` is called from its handler too.
+    """
+    stopped = []
+
+    def stop_once() -> bool:
+        if len(stopped) > 0:
+            return False
+        stopped.append(True)
+        stop()
+        return True
+
+    atexit.register(stop_once)
+    multiprocessing.util.register_after_fork(
+        owner, lambda _: multiprocessing.util.Finalize(None, stop_once, exitpriority=10)
+    )
+    _stop_on_sigterm(stop_once)
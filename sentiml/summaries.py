@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import reprlib
+from typing import Any, Callable, Optional
+
+# Longest string or bytes value kept as an argument.
+MAX_LENGTH = 128
+
+_PLAIN_TYPES = (type(None), bool, int, float, complex)
+
+
+
+class Summary:
+    """Cheap capture of an argument, only formatted once it's dumped."""
+    __slots__ = ("kind", "fields")
+
+    def __init__(self, kind: str, fields: tuple[tuple[str, Any], ...]):
+        self.kind = kind
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return f"{self.kind}({', '.join(f'{name}={value}' for name, value in self.fields)})"
+
+
+Summarizer = Callable[[Any], Any]
+
+# "module.QualName" of a type => Summarizer for instances of it & its subclasses.
+_summarizers: dict[str, Summarizer] = dict()
+# Type => Summarizer resolved through its MRO, None where reprlib is used.
+_resolved: dict[type, Optional[Summarizer]] = dict()
+
+
+def register_summarizer(type_name: str, summarizer: Summarizer) -> None:
+    """Summarize instances of the type named `type_name`, e.g. "numpy.ndarray", with `summarizer`.
+
+    Types are matched by name so that summarizing never imports the library.
+    """
+    _summarizers[type_name] = summarizer
+    _resolved.clear()
+
+
+def _summarizer_for(value_type: type) -> Optional[Summarizer]:
+    try:
+        return _resolved[value_type]
+    except KeyError:
+        pass
+    summarizer = None
+    for base in getattr(value_type, '__mro__', ()):
+        if (summarizer := _summarizers.get(f"{base.__module__}.{base.__qualname__}")) is not None:
+            break
+    _resolved[value_type] = summarizer
+    return summarizer
+
+
+class _SummarizingRepr(reprlib.Repr):
+    """reprlib.Repr which formats registered types nested within containers by their summarizer."""
+
+    def repr1(self, x: Any, level: int) -> str:
+        if (summarizer := _summarizer_for(type(x))) is not None:
+            return str(summarizer(x))
+        return super().repr1(x, level)
+
+
+_repr = _SummarizingRepr()
+_repr.maxstring = MAX_LENGTH
+_repr.maxother = MAX_LENGTH
+_repr.maxlevel = 2
+
+
+def summarize(value: Any) -> Any:
+    """Bounded stand-in for `value`, which is formatted with `str` when dumped.
+
+    Immutable scalars are kept as they are, strings & bytes are truncated, registered
+    types are summarized by their registered summarizer, and anything else is
+    captured with a length-capped `reprlib` repr, within which registered types
+    are summarized too.
+    """
+    value_type = type(value)
+    if value_type in _PLAIN_TYPES:
+        return value
+    if value_type is str:
+        return value if len(value) <= MAX_LENGTH else value[:MAX_LENGTH] + "..."
+    if value_type is bytes:
+        return value if len(value) <= MAX_LENGTH else value[:MAX_LENGTH] + b"..."
+    try:
+        if (summarizer := _summarizer_for(value_type)) is not None:
+            return summarizer(value)
+        return _repr.repr(value)
+    except BaseException:
+        return f"<{value_type.__qualname__}>"
+
+
+def _array(value: Any) -> Summary:
+    return Summary(type(value).__name__, (("shape", tuple(value.shape)), ("dtype", value.dtype)))
+
+
+def _tensor(value: Any) -> Summary:
+    return Summary(
+        type(value).__name__,
+        (("shape", tuple(value.shape)), ("dtype", value.dtype), ("device", value.device)),
+    )
+
+
+def _data_frame(value: Any) -> Summary:
+    columns = value.columns
+    return Summary(type(value).__name__, (("shape", value.shape), ("columns", _repr.repr(list(columns[:16])))))
+
+
+def _series(value: Any) -> Summary:
+    return Summary(type(value).__name__, (("shape", value.shape), ("dtype", value.dtype), ("name", value.name)))
+
+
+def _module(value: Any) -> Summary:
+    # nn.Module reprs print the whole model.
+    return Summary(type(value).__name__, ())
+
+
+register_summarizer("numpy.ndarray", _array)
+register_summarizer("torch.Tensor", _tensor)
+register_summarizer("torch.nn.modules.module.Module", _module)
+register_summarizer("pandas.core.frame.DataFrame", _data_frame)
+register_summarizer("pandas.core.series.Series", _series)
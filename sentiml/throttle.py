@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sentiml.protocols import CodeProtocol
+from sentiml.stack_element import StackElement, CodeInfo
+
+
+@dataclass
+class ThrottlePolicy:
+    """Stops capturing hot code objects in full, to bound the overhead of tracing.
+
+    A code object is throttled once it has been captured `max_captures` times, or
+    once the time spent capturing calls exceeds `overhead_budget` (a fraction) of
+    the wall time since tracing started. Calls to throttled code are only counted
+    against the element already captured along the same call path, or beneath a
+    parent with none, against a single element without arguments. With
+    `disable` set, backends which can turn off events for a code object do so.
+    """
+    max_captures: Optional[int] = None
+    overhead_budget: Optional[float] = None
+    # Seconds of tracing before the budget applies, as every early call is a first capture.
+    budget_warmup: float = 1.0
+    # Disabled code isn't pushed either, so its callees are attributed to its caller.
+    disable: bool = False
+    _captures: dict[CodeProtocol, int] = field(default_factory=dict, init=False, repr=False)
+    _throttled: set[CodeProtocol] = field(default_factory=set, init=False, repr=False)
+    # (id(Anchor), Code) => Element which throttled calls are counted against.
+    _counted: dict[tuple[int, CodeProtocol], StackElement] = field(default_factory=dict, init=False, repr=False)
+    # Code => Info of its latest capture, for the elements its calls are counted against beneath new anchors.
+    _infos: dict[CodeProtocol, CodeInfo] = field(default_factory=dict, init=False, repr=False)
+    _capture_ns: int = field(default=0, init=False, repr=False)
+    _started_ns: int = field(default=0, init=False, repr=False)
+
+    def start(self) -> None:
+        self._captures = dict()
+        self._throttled = set()
+        self._counted = dict()
+        self._infos = dict()
+        self._capture_ns = 0
+        self._started_ns = time.perf_counter_ns()
+
+    def is_throttled(self, code: CodeProtocol) -> bool:
+        return code in self._throttled
+
+    def is_disabled(self, code: CodeProtocol) -> bool:
+        return self.disable and code in self._throttled
+
+    def counted_element(self, anchor: Optional[StackElement], code: CodeProtocol) -> Optional[StackElement]:
+        return self._counted.get((id(anchor), code))
+
+    def uncaptured_element(
+            self, anchor: Optional[StackElement], code: CodeProtocol, depth: int
+    ) -> Optional[StackElement]:
+        """Element to count calls to `code` against beneath `anchor`, where none was captured, without arguments.
+
+        It shares the info of the captured elements, so identical subtrees beneath other anchors still match it.
+        """
+        if (info := self._infos.get(code)) is None:
+            return None
+        return StackElement(info=info, parent=anchor, depth=depth)
+
+    def count_against(self, anchor: Optional[StackElement], code: CodeProtocol, element: StackElement) -> None:
+        """Count later calls to `code` beneath `anchor` against `element`."""
+        self._counted[(id(anchor), code)] = element
+
+    def replace(self, element: StackElement, canonical: StackElement) -> None:
+        """Count calls against `canonical` wherever they were counted against `element`, which it replaced."""
+        key = (id(canonical.parent), element.description)
+        if self._counted.get(key) is element:
+            self._counted[key] = canonical
+
+    def forget(self, dropped_ids: frozenset[int]) -> None:
+        """Stop counting calls against, or beneath, the elements in `dropped_ids`, which were dropped from a stack."""
+        # Other threads may be counting calls meanwhile.
+        for key, element in list(self._counted.items()):
+            if key[0] in dropped_ids or id(element) in dropped_ids:
+                self._counted.pop(key, None)
+
+    def overhead(self) -> float:
+        """Fraction of the wall time since tracing started which was spent capturing calls."""
+        elapsed_ns = time.perf_counter_ns() - self._started_ns
+        return self._capture_ns / elapsed_ns if elapsed_ns > 0 else 0.0
+
+    def record_capture(
+            self,
+            anchor: Optional[StackElement],
+            code: CodeProtocol,
+            element: Optional[StackElement],
+            capture_ns: int,
+    ) -> None:
+        """Note that a call to `code` beneath `anchor` was captured as `element`, taking `capture_ns`."""
+        self._capture_ns += capture_ns
+        captures = self._captures[code] = self._captures.get(code, 0) + 1
+        if element is not None:
+            self._counted[(id(anchor), code)] = element
+            self._infos[code] = element.info
+        if (
+                (self.max_captures is not None and captures >= self.max_captures)
+                or (
+                        self.overhead_budget is not None
+                        and time.perf_counter_ns() - self._started_ns > self.budget_warmup * 1e9
+                        and self.overhead() > self.overhead_budget
+                )
+        ):
+            self._throttled.add(code)
+
+    def throttled(self) -> set[CodeProtocol]:
+        return set(self._throttled)
@@ -1,24 +1,59 @@
+import os
 import uuid
 import pathlib
+from typing import Optional
+
+
+# Set for child processes started while tracking, which they carry on with as workers.
+TRACKING_TYPE_VARIABLE = "SENTIML_TRACKING_TYPE"
 
 
 class TraceID:
-    _id = uuid.uuid4()
+    # Set for child processes so that every process of a run shares one trace.
+    ENVIRONMENT_VARIABLE = "SENTIML_TRACE_ID"
+    # Only workers join their parent's run, other children which track are runs of their own.
+    _id = (
+        uuid.UUID(os.environ[ENVIRONMENT_VARIABLE])
+        if ENVIRONMENT_VARIABLE in os.environ and TRACKING_TYPE_VARIABLE in os.environ
+        else uuid.uuid4()
+    )
+    # Set within worker processes, which write to their own shard of the run.
+    _shard: Optional[str] = None
 
     @classmethod
     def reset(cls) -> None:
         cls._id = uuid.uuid4()
 
+    @classmethod
+    def use(cls, trace_id: uuid.UUID) -> None:
+        cls._id = trace_id
+
     @classmethod
     def id(cls) -> uuid.UUID:
         return cls._id
-    
+
     @classmethod
-    def root_dir(cls) -> pathlib.Path:
-        root_dir = (
+    def use_shard(cls, shard: Optional[str]) -> None:
+        cls._shard = shard
+
+    @classmethod
+    def run_dir(cls) -> pathlib.Path:
+        run_dir = (
                 pathlib.Path.home()
                 / ".stack_traces"
                 / str(TraceID.id())
         )
+        run_dir.mkdir(parents=True, exist_ok=True)
+        return run_dir
+
+    @classmethod
+    def shards_dir(cls) -> pathlib.Path:
+        return cls.run_dir() / "shards"
+
+    @classmethod
+    def root_dir(cls) -> pathlib.Path:
+        if cls._shard is None:
+            return cls.run_dir()
+        root_dir = cls.shards_dir() / cls._shard
         root_dir.mkdir(parents=True, exist_ok=True)
-        return root_dir
\ No newline at end of file
+        return root_dir
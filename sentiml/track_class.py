@@ -1,20 +1,102 @@
 import json
 import atexit
+import hashlib
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
 from sentiml.trace_id import TraceID
 from weaver.weave import weave
 
 from uuid import uuid4
 
-from typing import TypeVar, Optional
-from functools import partial
+from typing import TypeVar, Optional, Any
 
 T = TypeVar('T')
 
+# Strings & lists which serialize to more bytes than this are written once as a blob & referenced by content hash.
+BLOB_SIZE = 4096
+
+# Class Name => Tracked Item, each serialized once per call to `serialize_tracked_classes`.
+_tracked: dict[str, Any] = dict()
+_tracked_lock = threading.Lock()
+# id(Item) => Class Name, for items which can't hold `__observer_class_name__`.
+_names_by_id: dict[int, str] = dict()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _classes_dir() -> pathlib.Path:
+    root_dir = TraceID.root_dir() / 'classes'
+    (root_dir / 'blobs').mkdir(exist_ok=True, parents=True)
+    return root_dir
+
+
+def _blob(encoded: bytes, blobs_dir: pathlib.Path) -> dict:
+    content_hash = hashlib.sha256(encoded).hexdigest()
+    path = blobs_dir / content_hash
+    # Unchanged parameters are only ever written once per run.
+    if not path.exists():
+        temporary_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        temporary_path.write_bytes(encoded)
+        temporary_path.replace(path)
+    return {"__blob__": content_hash, "size": len(encoded)}
+
+
+def _replace_blobs(value: Any, blobs_dir: pathlib.Path) -> Any:
+    """`value` with each string or list that serializes to more than BLOB_SIZE bytes replaced by a blob.
+
+    Lists are judged by their serialized size as a whole, so that nested ones, e.g. a
+    matrix of parameters, become a single blob however their items are split up.
+    """
+    if isinstance(value, dict):
+        return {key: _replace_blobs(item, blobs_dir) for key, item in value.items()}
+    if isinstance(value, str) and len(value) > BLOB_SIZE // 4:
+        # At most 4 bytes per character, so shorter strings can't be over the limit.
+        if len(encoded := value.encode()) > BLOB_SIZE:
+            return _blob(encoded, blobs_dir)
+    elif isinstance(value, (list, tuple)):
+        if any(isinstance(item, dict) for item in value):
+            # Structure rather than data, e.g. one dict per layer, so only its contents are blobbed.
+            return [_replace_blobs(item, blobs_dir) for item in value]
+        if len(encoded := json.dumps(value, default=str).encode()) > BLOB_SIZE:
+            return _blob(encoded, blobs_dir)
+    return value
+
+
+def _serialize(class_name: str, item: Any) -> None:
+    root_dir = _classes_dir()
+    res: dict = _replace_blobs(weave(item).as_dict(), root_dir / 'blobs')
+    with open(root_dir / f"{class_name}.json", 'w') as f:
+        json.dump(res, f)
+
+
+def serialize_tracked_classes(block: bool = True) -> list[Future]:
+    """Serialize every tracked item on a pool of worker threads.
+
+    Can be called at any point, e.g. between phases, rather than waiting for exit.
+    Returns the futures of each item's serialization, having waited for them if `block`.
+    """
+    global _executor
+    with _tracked_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(thread_name_prefix="sentiml-track-class")
+        try:
+            futures = [_executor.submit(_serialize, name, item) for name, item in _tracked.items()]
+        except RuntimeError:
+            # The pool no longer accepts work once the interpreter is shutting down.
+            for name, item in _tracked.items():
+                _serialize(name, item)
+            return []
+    if block:
+        wait(futures)
+    return futures
+
 
 def track_class(item: T, class_name: Optional[str] = None) -> None:
     if (existing_class_name := getattr(item, '__observer_class_name__', None)) is not None:
         inner_class_name = existing_class_name
+    elif (existing_class_name := _names_by_id.get(id(item))) is not None:
+        inner_class_name = existing_class_name
     elif class_name is not None:
         inner_class_name = class_name
     else:
@@ -23,12 +105,14 @@ def track_class(item: T, class_name: Optional[str] = None) -> None:
         setattr(item, '__observer_class_name__', inner_class_name)
     except BaseException:
         # It's nice to have a consistent name for an object, but it's fairly trivial.
-        pass
-    def teardown(cls):
-        res: dict = weave(cls).as_dict()
-        root_dir = TraceID.root_dir() / 'classes'
-        root_dir.mkdir(exist_ok=True, parents=True)
-        with open(root_dir / f"{inner_class_name}.json", 'w') as f:
-            json.dump(res, f)
-
-    atexit.register(partial(teardown, cls=item))
+        _names_by_id[id(item)] = inner_class_name
+    with _tracked_lock:
+        # Tracking an item again only replaces its registration.
+        _tracked[inner_class_name] = item
+
+
+if hasattr(threading, '_register_atexit'):
+    # Runs before the pool's own exit hook, while it still accepts work.
+    threading._register_atexit(serialize_tracked_classes)
+else:
+    atexit.register(serialize_tracked_classes)
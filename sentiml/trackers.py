@@ -1,35 +1,75 @@
-import json
-import pathlib
-import pkgutil
-import sys
-from typing import Optional, Any, Callable, Iterator
+from __future__ import annotations
 
-from importlib.metadata import version, PackageNotFoundError
+import atexit
+import contextlib
+import json
+import os
+import threading
+from typing import Optional, Any, Sequence
 
 
-from sentiml.protocols import FrameProtocol
-from sentiml.stack_element import StackElement, NotIncludedError
+from sentiml.backends import TracingBackend, SetTraceBackend, SamplingBackend, ImportHookBackend, default_backend
+from sentiml.environment import loaded_module_versions
+from sentiml.inclusion import InclusionRules, use_rules
+from sentiml.limits import StackLimits
 from sentiml.stack_trace import NodeStack
 from sentiml.stacks import TrainStack, InferStack, ProcessingStack
+from sentiml.subprocesses import export_tracking, inherited_tracking, inherited_rules, become_worker, stop_on_exit
+from sentiml.throttle import ThrottlePolicy
 from sentiml.trace_id import TraceID
 from sentiml.tracking_type import TrackingType
 
 
 class Observer:
     _type: Optional[TrackingType] = None
-    _previous_tracking_fn: Optional[Callable] = None
+    _backend: Optional[TracingBackend] = None
     _relevant_tracker: Optional[NodeStack] = None
+    # Rules the session was started with, to pass on to workers.
+    _rules: Optional[InclusionRules] = None
+    # Set while tracking but not reporting calls, i.e. outside of every traced region.
+    _paused: bool = False
+    _open_regions: int = 0
+    # Whether tracking was started or resumed by the regions, which pause it once they're all closed.
+    _regions_own_tracking: bool = False
+    # Set while a region starts tracking, which then only needs the threads within regions.
+    _starting_regions: bool = False
+    # Regions open on each thread, as `depth`.
+    _thread_regions = threading.local()
+    _regions_lock = threading.Lock()
+    _stops_on_exit: bool = False
 
     @classmethod
     def is_active(cls) -> bool:
         return cls._relevant_tracker is not None
 
     @classmethod
-    def track(cls, tracking_type: TrackingType) -> None:
+    def track(
+            cls,
+            tracking_type: TrackingType,
+            backend: Optional[TracingBackend] = None,
+            aggregate: bool = False,
+            stream: bool = False,
+            asyncio_tasks: bool = False,
+            task_sample_rate: float = 1.0,
+            throttle: Optional[ThrottlePolicy] = None,
+            rules: Optional[InclusionRules] = None,
+            limits: Optional[StackLimits] = None,
+    ) -> None:
+        """Start tracking calls as `tracking_type`.
+
+        With `asyncio_tasks`, each asyncio Task is traced as its own call stack beneath
+        the call which created it, and only `task_sample_rate` of the top-level Tasks
+        are recorded. With `throttle`, hot code objects stop being captured in full
+        once they hit the policy's capture count or overhead budget. These are
+        ignored when a `backend` is given.
+
+        `rules` replace the include & exclude rules read from the environment until
+        tracking stops, in worker processes too, and `limits` bound the memory held
+        by the stack, e.g. for a long-running service.
+        """
         if cls.is_active():
             cls.stop()
         cls._type = tracking_type
-        cls._previous_tracking_fn = sys.gettrace()
         if tracking_type == TrackingType.Training:
             cls._relevant_tracker = TrainStack
         elif tracking_type == TrackingType.Inference:
@@ -39,47 +79,198 @@ class Observer:
         else:
             raise RuntimeError(f"Unknown Stack Type {tracking_type}")
 
-        def tracking_fn(
-                frame: Optional[FrameProtocol], event: str, arg_frame: Optional[Any]
-        ):
-            if event == "call" and frame is not None:
-                try:
-                    cls._relevant_tracker.add_node(StackElement.from_frame(frame))
-                except NotIncludedError:
-                    pass
-            if cls._previous_tracking_fn is not None:
-                cls._previous_tracking_fn(frame, event, arg_frame)
-
-        sys.settrace(tracking_fn)
-
-    @staticmethod
-    def _loaded_libraries() -> Iterator[tuple[str, str]]:
-        installed_packages = list(pkgutil.iter_modules())
-        for module in installed_packages:
-            try:
-                yield module.name, version(module.name)
-            except PackageNotFoundError:
-                pass
+        # Rules given to an earlier session don't outlive it.
+        use_rules(rules if rules is not None else InclusionRules.from_environment())
+        if throttle is not None:
+            throttle.start()
+        cls._relevant_tracker.aggregate = aggregate
+        cls._relevant_tracker.limits = limits
+        if stream:
+            cls._relevant_tracker.stream()
+        call_stack_options = dict(asyncio_tasks=asyncio_tasks, task_sample_rate=task_sample_rate, throttle=throttle)
+        cls._backend = backend if backend is not None else default_backend(**call_stack_options)
+        try:
+            cls._start_backend()
+        except RuntimeError:
+            if backend is not None:
+                raise
+            # e.g. every sys.monitoring tool id is already taken by another tool.
+            cls._backend = SetTraceBackend(**call_stack_options)
+            cls._start_backend()
+        cls._rules = rules
+        export_tracking(tracking_type, rules)
+
+    @classmethod
+    def _start_backend(cls) -> None:
+        if cls._starting_regions:
+            cls._backend.start_regions(cls._relevant_tracker)
+        else:
+            cls._backend.start(cls._relevant_tracker)
+
+    @classmethod
+    def sample(cls, tracking_type: TrackingType, rate: float = 100.0, limits: Optional[StackLimits] = None) -> None:
+        """Track `tracking_type` by sampling every thread's stack `rate` times a second, within `limits`."""
+        cls.track(tracking_type, backend=SamplingBackend(rate), limits=limits)
+
+    @classmethod
+    def wrap_imports(cls, tracking_type: TrackingType, packages: Sequence[str], **call_stack_options) -> None:
+        """Track `tracking_type` by wrapping the functions & methods of `packages`, without a global hook."""
+        cls.track(tracking_type, backend=ImportHookBackend(packages, **call_stack_options))
 
     @classmethod
     def save_libraries(cls) -> None:
-        library_dest = (
-                pathlib.Path.home()
-                / ".stack_traces"
-                / str(TraceID.id())
-                / "versions.txt"
-        )
-        if not library_dest.exists():
+        """Add the versions of modules imported since the last stop to those already saved for the run."""
+        library_dest = TraceID.root_dir() / "versions.txt"
+        versions = dict()
+        try:
+            with open(library_dest) as f:
+                versions = json.load(f)
+        except (OSError, ValueError):
+            pass
+        loaded = loaded_module_versions()
+        if not loaded.keys() <= versions.keys():
+            versions.update(loaded)
             with open(library_dest, 'w') as f:
-                json.dump(dict(cls._loaded_libraries()), f)
+                json.dump(dict(sorted(versions.items())), f)
 
     @classmethod
     def stop(cls) -> None:
+        if not cls.is_active():
+            return None
+        export_tracking(None)
         cls._type = None
+        cls._backend.stop()
+        cls._backend = None
+        cls._paused = False
+        cls._regions_own_tracking = False
         cls._relevant_tracker.dump()
         cls.save_libraries()
         cls._relevant_tracker = None
-        sys.settrace(cls._previous_tracking_fn)
-        # Ensure that new StackElements from functions don't share children with previous StackElements.
-        StackElement.from_frame.cache_clear()
-        cls._previous_tracking_fn = None
+
+    @classmethod
+    def pause(cls) -> None:
+        """Stop reporting calls until `resume`, keeping everything recorded so far."""
+        if cls.is_active() and not cls._paused:
+            cls._backend.pause()
+            cls._paused = True
+            # Processes started while paused aren't workers of the session.
+            export_tracking(None)
+
+    @classmethod
+    def resume(cls) -> None:
+        if cls.is_active() and cls._paused:
+            cls._backend.resume(cls._relevant_tracker)
+            cls._paused = False
+            export_tracking(cls._type, cls._rules)
+
+    @classmethod
+    def _open_region(cls, tracking_type: TrackingType, track_options: dict[str, Any]) -> None:
+        with cls._regions_lock:
+            if cls._open_regions == 0:
+                if cls._type is not tracking_type:
+                    cls._starting_regions = True
+                    try:
+                        cls.track(tracking_type, **track_options)
+                    finally:
+                        cls._starting_regions = False
+                    cls._regions_own_tracking = True
+                elif cls._paused:
+                    if cls._regions_own_tracking:
+                        cls.resume()
+                    else:
+                        # Paused by the caller of `track`, so only the regions are traced from here on.
+                        cls._backend.stop()
+                        cls._backend.start_regions(cls._relevant_tracker)
+                        cls._paused = False
+                        export_tracking(cls._type, cls._rules)
+                    cls._regions_own_tracking = True
+                else:
+                    # Tracking was started with `track`, so leave it running.
+                    cls._regions_own_tracking = False
+                if cls._regions_own_tracking and not cls._stops_on_exit:
+                    atexit.register(cls.stop)
+                    cls._stops_on_exit = True
+            cls._open_regions += 1
+            thread_regions = getattr(cls._thread_regions, 'depth', 0)
+            cls._thread_regions.depth = thread_regions + 1
+            if thread_regions == 0:
+                cls._backend.enter_region()
+
+    @classmethod
+    def _close_region(cls) -> None:
+        with cls._regions_lock:
+            cls._thread_regions.depth -= 1
+            if cls._thread_regions.depth == 0 and cls._backend is not None:
+                cls._backend.exit_region()
+            cls._open_regions -= 1
+            if cls._open_regions == 0 and cls._regions_own_tracking:
+                cls.pause()
+
+    @classmethod
+    def _after_fork_in_child(cls) -> None:
+        """Restart tracking within a forked worker, which inherited a copy of its parent's stack.
+
+        Workers stream their calls, so whatever they recorded survives them being killed.
+        """
+        if not cls.is_active():
+            return None
+        become_worker()
+        cls._relevant_tracker.reset()
+        cls._relevant_tracker.stream()
+        # Only the forking thread survives, along with the regions it had open.
+        cls._open_regions = getattr(cls._thread_regions, 'depth', 0)
+        if not cls._paused:
+            cls._backend.stop()
+            cls._backend.resume(cls._relevant_tracker)
+            if cls._open_regions > 0:
+                cls._backend.enter_region()
+        stop_on_exit(cls, cls.stop)
+
+    @classmethod
+    def _resume_in_child(cls) -> None:
+        """Continue tracking within a spawned worker, which was started while its parent was tracking."""
+        if (tracking_type := inherited_tracking()) is not None and not cls.is_active():
+            become_worker()
+            cls.track(tracking_type, stream=True, rules=inherited_rules())
+            stop_on_exit(cls, cls.stop)
+
+
+class TracedRegion(contextlib.ContextDecorator):
+    """Decorator & context manager which only traces calls while some region is open.
+
+    The tracing hook is installed when the first region opens and removed once
+    the last closes, so code outside of every region runs untraced. Calls within
+    regions are recorded into the same NodeStack as `Observer.track(tracking_type)`,
+    which is dumped by `Observer.stop`, or at exit.
+
+    Under sys.settrace, only threads within a region are traced. Other backends
+    hook every thread at once, so they trace every thread while any region is
+    open. Either way, calls are recorded from the first call each thread makes
+    while traced, rather than beneath the frames which opened a region, and
+    every region records into the same per-thread stacks.
+    """
+
+    def __init__(self, tracking_type: TrackingType, **track_options):
+        self.tracking_type = tracking_type
+        self.track_options = track_options
+
+    def __enter__(self) -> TracedRegion:
+        Observer._open_region(self.tracking_type, self.track_options)
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        Observer._close_region()
+        return False
+
+
+def traced(tracking_type: TrackingType, **track_options) -> TracedRegion:
+    """Trace calls as `tracking_type` only within the decorated callable or `with` block.
+
+    `track_options` are passed to `Observer.track` when tracking starts.
+    """
+    return TracedRegion(tracking_type, **track_options)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=Observer._after_fork_in_child)
+Observer._resume_in_child()